@@ -1,9 +1,8 @@
 import matplotlib.pyplot as plt
-import copy,os,sys,time
+import copy,os,sys,time,json
 import numpy as np
 from numpy.polynomial.polynomial import Polynomial
 from tqdm.notebook import trange, tqdm
-from scipy.interpolate import interp1d
 from scipy.optimize import minimize
 
 """
@@ -182,54 +181,88 @@ class Scan():
             If average is False, this is a list of lists of ndarrays of complex values.    The ndarray of complex values does not always have the same number of samples, hence the need for a list of lists.
             
             If average is True, this is a 2D array of the average complex value of the samples.
+
+            unpackRagged returns the samples in one array, without building the lists.
         """
         if verbose: print("self.packets.shape =",self.packets.shape)
         packets = self.packets[:, iBegin:, :]
         if verbose: print("     packets.shape =",packets.shape)
-        ntrans = packets[:,:,16]
-        if verbose: print("      ntrans.shape =",ntrans.shape)
-        xis = packets[:,:,0:16:2]
-        if verbose: print("         xis.shape =",xis.shape)
-        xqs = packets[:,:,1:17:2]
-        if verbose: print("         xqs.shape =",xqs.shape)
-        xs = xis + 1j*xqs
-        if verbose: print("          xs.shape =",xs.shape)
-        xsByNtTone = []
-        nt = xs.shape[0]
+        nt = packets.shape[0]
         nTone = len(self.ntranByTone)
-        for it in range(nt):
-            xsByTone = []
-            for iTone,(ntran,stream) in enumerate(zip(self.ntranByTone,self.streamByTone)):
-                temp = copy.deepcopy(xs[it, ntrans[it]==ntran, stream])
-                if verbose: print("   nt, iTone , x.shape", it, iTone, temp.shape)
-
-                if subtractInputPhase:
-                    temp = self._subtractInputPhase(temp, 
-                                                self.toneFis[iTone])
-                xsByTone.append(temp)
-            xsByNtTone.append(xsByTone)
         if average:
-            retval = np.zeros((nt,nTone), dtype=complex)
-            for it in range(nt):
-                for iTone in range(nTone):
-                    retval[it,iTone] =  xsByNtTone[it][iTone].mean()
+            # Mean of each (transfer, tone), from sums over the samples
+            xis, xqs, offsets = self._gatherTones(packets)
+            counts = np.diff(offsets)
+            segments = np.repeat(np.arange(nt*nTone), counts)
+            sumI = np.bincount(segments, weights=xis, minlength=nt*nTone)
+            sumQ = np.bincount(segments, weights=xqs, minlength=nt*nTone)
+            retval = ((sumI + 1j*sumQ)/counts).reshape((nt,nTone))
+            if subtractInputPhase:
+                retval *= self._inputPhasors()
             retval = retval.mean(axis=0)
         else:
-            retval = xsByNtTone
+            xs, offsets = self.unpackRagged(subtractInputPhase=subtractInputPhase, iBegin=iBegin)
+            retval = [[xs[offsets[it*nTone+iTone]:offsets[it*nTone+iTone+1]] for iTone in range(nTone)]
+                      for it in range(nt)]
         return retval
 
-    def _subtractInputPhase(self, x, toneFi):
+    def unpackRagged(self, subtractInputPhase=True, iBegin=0):
+        """
+        unpack the packets of all the tones in one pass
+        Parameters
+        ----------
+            subtractInputPhase : boolean
+                True to subtract the phase of the generated tone; default True
+            iBegin : int
+                sample number to begin using; default 0
+        Returns
+        -------
+            xs, offsets : ndarray of complex, ndarray of int
+
+            The samples of transfer it and tone iTone are xs[offsets[k]:offsets[k+1]] with k = it*nTone + iTone,
+            where nTone = len(self.ntranByTone)
+        """
+        packets = self.packets[:, iBegin:, :]
+        xis, xqs, offsets = self._gatherTones(packets)
+        xs = xis + 1j*xqs
+        if subtractInputPhase:
+            nt = packets.shape[0]
+            xs *= np.repeat(np.tile(self._inputPhasors(), nt), np.diff(offsets))
+        return xs, offsets
+
+    def _gatherTones(self, packets):
         """
-        Return values with phase of x 
-        corrected by the generated phase toneFi (in Radians)
+        I and Q samples of each (transfer, tone), ordered by transfer then tone, and the offsets of each
+        (transfer, tone) in them.  Samples are grouped by transfer and transaction number with one stable sort.
         """
-        nZone = self.soc.nZone
-        nzSign = 1-2*np.mod(nZone,2)
+        nt, nsamp, nCol = packets.shape
+        ntrans = packets[:,:,16].astype(np.intp)
+        ntranByTone = np.asarray(self.ntranByTone, dtype=np.intp)
+        streamByTone = np.asarray(self.streamByTone, dtype=np.intp)
+        nKey = max(ntrans.max(initial=0), ntranByTone.max(initial=0)) + 1
+        keys = (np.arange(nt)[:,np.newaxis]*nKey + ntrans).ravel()
+        order = np.argsort(keys, kind='stable')
+        keyCounts = np.bincount(keys, minlength=nt*nKey)
+        keyStarts = np.cumsum(keyCounts) - keyCounts
+
+        # Range of each (transfer, tone) in the sorted samples
+        toneKeys = (np.arange(nt)[:,np.newaxis]*nKey + ntranByTone).ravel()
+        counts = keyCounts[toneKeys]
+        offsets = np.concatenate(([0], np.cumsum(counts)))
+        rows = order[np.arange(offsets[-1]) + np.repeat(keyStarts[toneKeys]-offsets[:-1], counts)]
+        cols = 2*np.repeat(np.tile(streamByTone, nt), counts)
+        samples = packets.reshape((nt*nsamp, nCol))
+        return samples[rows, cols].astype(float), samples[rows, cols+1].astype(float), offsets
+
+    def _inputPhasors(self):
+        """
+        Phasor of each tone to subtract the generated phase toneFis (in Radians)
+        """
+        nzSign = 1-2*np.mod(self.soc.nZone,2)
         # nzSign is:
         #    -1 in odd-numbered Nyquist zones 
         #    +1 in even-number Nyquist zones
-        xrot = np.abs(x)*np.exp(1j * (np.angle(x) + nzSign*toneFi))
-        return xrot
+        return np.exp(1j*nzSign*np.asarray(self.toneFis, dtype=float))
 
     def fscan(self, freqs, amps, fis, 
               bandwidth, nf, decimation, nt, iBegin=200, nsamp=10000,
@@ -403,7 +436,10 @@ class Scan():
                 Number of samples for each transfer; default=10000
             nominalDelay : int
                 Delay to use.  Default=None applies no phase correction due to delay
-                
+
+        Returns:
+        --------
+            a Calibration (a dict), which can be saved with saveCalibration
         """
         fcMax = max(self.soc.fcIn, self.soc.fcOut)
         fcMin = min(self.soc.fcIn, self.soc.fcOut)
@@ -431,16 +467,16 @@ class Scan():
         fList = self.makeFList(fMixer, fMin, fMax)
         sFreqs, fAmps, sFis = fscanToSpectrum(fscan)
         sxs = fAmps*np.exp(1j*sFis)
-        cInterps = []
-        for i in range(len(fList)-1):
-            f0 = fList[i]
-            f1 = fList[i+1]
-            inds = (f0 < sFreqs) & (sFreqs < f1)
-            interp = interp1d(sFreqs[inds], sxs[inds], bounds_error=False, fill_value="extrapolate")
-            cInterps.append(interp)
-        calib = {"fMixer":fMixer, "fList":fList, "cInterps":cInterps, 
+        # Knots of segment i are the points strictly between fList[i] and fList[i+1]
+        i0 = np.searchsorted(sFreqs, fList[:-1], side='right')
+        i1 = np.searchsorted(sFreqs, fList[1:], side='left')
+        inds = np.concatenate([np.arange(a, b) for a,b in zip(i0, i1)]).astype(int)
+        segStarts = np.concatenate(([0], np.cumsum(i1-i0)))
+        calib = Calibration({"fMixer":fMixer, "fList":fList,
                  "fMin":fMin, "fMax":fMax, "fscan":fscan,
-                 "nominalDelay":nominalDelay} 
+                 "nominalDelay":nominalDelay,
+                 "knotFreqs":sFreqs[inds], "knotXs":sxs[inds], "segStarts":segStarts})
+        calib.checkKnots()
         return calib
     
     def measureNominalDelay(self, outCh, nf=20, nt=1, doProgress=False, doPlot=False, decimation=32, iBegin=500, pfbOutQout=0, nsamp=10000):
@@ -549,19 +585,19 @@ class Scan():
             fscan['delayApplied'] += delay
         except KeyError:
             fscan['delayApplied'] =  delay
-        for iTone in range(fscan['xs'].shape[1]):
-            xs = fscan['xs'][:,iTone]
-            freqs = fscan['dfs'] + fscan['freqs'][iTone]
-            aliasedFreqs = self.soc.fAliasedFromFTone(freqs)
-            fscan['xs'][:,iTone] = np.abs(xs)*np.exp( 1j*(np.angle(xs) - delay*aliasedFreqs) )
-            #fscan['xs'][:,iTone] = np.abs(xs)*np.exp( 1j*(np.angle(xs) - delay*freqs) )
+        # All (offset, tone) frequencies at once
+        xs = fscan['xs']
+        freqs = fscan['dfs'][:,np.newaxis] + fscan['freqs']
+        aliasedFreqs = self.soc.fAliasedFromFTone(freqs)
+        # Rotate with a complex multiply, in place
+        xs *= np.exp(-1j*delay*aliasedFreqs)
 
     def applyDelayToX(self, xs, freqs, delay):
         aliasedFreqs = self.soc.fAliasedFromFTone(freqs)
-        xsd = np.abs(xs)*np.exp(1j*(np.angle(xs) - delay*aliasedFreqs))
+        xsd = xs*np.exp(-1j*delay*aliasedFreqs)
         return xsd
     
-    def applyCalibration(self, fscan, calibration, amplitudeMax=30000):
+    def applyCalibration(self, fscan, calibration, amplitudeMax=30000, inPlace=False):
         """
         Apply the calibration to the frequency scan
 
@@ -573,29 +609,31 @@ class Scan():
                 returned from the function makeCalibration
             amplitudeMax : float
                 amplitude of measurement when amplitudes of fscan and calibration are equal
+            inPlace : boolean
+                True to apply the calibration to fscan itself, instead of a deep copy; default=False
 
         Returns:
         --------
-            a deep copy of fscan with the calibration applied.
+            fscan with the calibration applied:  a deep copy of fscan, or fscan if inPlace is True
         """
-        fscanCalib = copy.deepcopy(fscan)
+        if not isinstance(calibration, Calibration):
+            calibration = Calibration.fromDict(calibration)
         nominalDelay = calibration['nominalDelay']
+        delayApplied = fscan.get('delayApplied', 0) + nominalDelay
+        if nominalDelay != delayApplied:
+            raise ValueError("fscan already had a delay applied", nominalDelay, delayApplied)
+        if inPlace:
+            fscanCalib = fscan
+        else:
+            fscanCalib = copy.deepcopy(fscan)
         self.applyDelay(fscanCalib, nominalDelay)
-        if nominalDelay != fscanCalib['delayApplied']:
-            raise ValueError("fscan already had a delay applied", nominalDelay, fscanCalib['delayApplied'])
         dfs = fscanCalib['dfs']
-        for iTone,(freq,xs) in enumerate(zip(fscanCalib['freqs'],fscanCalib['xs'])):
-            freqs = freq+dfs
-            xCalib = np.zeros(len(freqs), dtype=complex)
-            for i, freq in enumerate(freqs):
-                iCalib = np.searchsorted(calibration['fList'], freq)-1 
-                xCalib[i] = calibration['cInterps'][iCalib](freq)
-            gain = (0.9/len(freqs))*amplitudeMax/np.abs(xCalib)
-            fscanCalib['xs'][:,iTone] *= gain
-            dfi = np.angle(xCalib)
-            xs = fscanCalib['xs'][:,iTone]
-            fscanCalib['xs'][:,iTone] = np.abs(xs)*np.exp(1j*(np.angle(xs)-dfi))
-        return fscanCalib                                                     
+        # Calibration at all the (offset, tone) frequencies at once
+        xCalib = calibration.interpolate(dfs[:,np.newaxis] + fscanCalib['freqs'])
+        # Scale by the gain and subtract the phase of the calibration in one multiply
+        gain = (0.9/len(dfs))*amplitudeMax
+        fscanCalib['xs'] *= gain*np.conj(xCalib)/(xCalib.real**2 + xCalib.imag**2)
+        return fscanCalib
 
 
 def fscanPlot(fscan, iTone, millirad=False, db=False):
@@ -629,7 +667,7 @@ def fscanPlot(fscan, iTone, millirad=False, db=False):
         
     ax[1].set_xlabel("Frequency-%f [MHz]"%fscan["freqs"][iTone])
     
-def fscanToSpectrum(fscan):
+def fscanToSpectrum(fscan, mergeRuns=False):
     """
     arrange values from fscan to a spectrum
     
@@ -637,6 +675,9 @@ def fscanToSpectrum(fscan):
     -----------
         fscan : object
             return value from function fscan
+        mergeRuns : boolean
+            True to merge the (sorted) scans of each tone instead of sorting all the values,
+            faster for many tones; values at equal frequencies may be in a different order.  default=False
     
     Return:
     -------
@@ -644,19 +685,207 @@ def fscanToSpectrum(fscan):
         where the three values are 1D ndarrays of frequency, amplitude, phase
 
     """
-    dfs = fscan['dfs']
-    freqs = fscan['freqs']
-    allfreqs = np.zeros((len(freqs),len(dfs)))
-    for i,fTone in enumerate(freqs):
-        allfreqs[i,:] = freqs[i]+dfs
-    allfreqs = allfreqs.ravel()
-    xs = np.transpose(fscan['xs'])
-    allamps = np.abs(xs).ravel()
-    allfis = np.angle(xs).ravel()
-    inds = np.argsort(allfreqs)
-    return allfreqs[inds], allamps[inds], allfis[inds]
+    dfs = np.asarray(fscan['dfs'], dtype=float)
+    freqs = np.asarray(fscan['freqs'], dtype=float)
+    # Frequencies tone by tone, as the rows of the transposed xs
+    allfreqs = (freqs[:,np.newaxis] + dfs).ravel()
+    if mergeRuns:
+        # Scan of each tone is a sorted run: lay them out by tone frequency, the stable sort (timsort)
+        # merges the runs, in one pass when they do not overlap
+        runs = (np.argsort(freqs, kind='stable')[:,np.newaxis]*len(dfs) + np.argsort(dfs, kind='stable')).ravel()
+        inds = runs[np.argsort(allfreqs[runs], kind='stable')]
+    else:
+        inds = np.argsort(allfreqs)
+    xs = np.transpose(fscan['xs']).ravel()[inds]
+    return allfreqs[inds], np.abs(xs), np.angle(xs)
    
         
+CALIBRATION_MAGIC = b"MKIDSCAL"
+CALIBRATION_VERSION = 1
+
+class Calibration(dict):
+    """
+    Calibration made by Scan.makeCalibration, a dict with the keys
+    fMixer, fList, fMin, fMax, fscan, nominalDelay and the knots of the interpolation:
+
+        knotFreqs : sorted frequencies of the knots of all segments
+        knotXs : complex values at the knots
+        segStarts : knots of segment i (between fList[i] and fList[i+1]) are [segStarts[i], segStarts[i+1])
+
+    Each segment is interpolated linearly, and extrapolated from its end knots, as
+    interp1d(..., fill_value="extrapolate") did.  calibration['cInterps'] still returns
+    one callable per segment, for code written for the list of interp1d.
+    """
+    def __missing__(self, key):
+        if key == "cInterps":
+            return [CalibrationSegment(self, i) for i in range(len(self['fList'])-1)]
+        raise KeyError(key)
+
+    @classmethod
+    def fromDict(cls, calib):
+        """
+        Convert a calibration dict with a list of interp1d in cInterps (for example an old pickle)
+        """
+        cInterps = calib['cInterps']
+        segStarts = np.concatenate(([0], np.cumsum([len(c.x) for c in cInterps])))
+        retval = cls({k:v for k,v in calib.items() if k != "cInterps"})
+        retval['knotFreqs'] = np.concatenate([c.x for c in cInterps])
+        retval['knotXs'] = np.concatenate([c.y for c in cInterps])
+        retval['segStarts'] = segStarts
+        retval.checkKnots()
+        return retval
+
+    def checkKnots(self):
+        nKnots = np.diff(self['segStarts'])
+        if len(nKnots) != len(self['fList'])-1:
+            raise ValueError("%d segments for %d values in fList"%(len(nKnots), len(self['fList'])))
+        if nKnots.min() < 2:
+            iSeg = np.argmin(nKnots)
+            raise ValueError("Calibration segment %d (%f to %f MHz) has %d knots, 2 are needed"%(
+                iSeg, self['fList'][iSeg], self['fList'][iSeg+1], nKnots[iSeg]))
+
+    def interpolate(self, freqs, iSegs=None):
+        """
+        Evaluate the calibration at the frequencies
+
+        Parameters:
+        -----------
+            freqs : ndarray
+                frequencies, in MHz, of any shape
+            iSegs : ndarray
+                segment to use for each frequency; default=None uses the segment
+                containing the frequency, or the first (last) segment below (above) fList
+
+        Returns:
+        --------
+            complex ndarray with the shape of freqs
+        """
+        freqs = np.asarray(freqs, dtype=float)
+        fList = self['fList']
+        knotFreqs = self['knotFreqs']
+        knotXs = self['knotXs']
+        segStarts = self['segStarts']
+        if iSegs is None:
+            iSegs = np.clip(np.searchsorted(fList, freqs)-1, 0, len(fList)-2)
+        # The knots are sorted over all segments, so one search finds the knot in the segment
+        hi = np.searchsorted(knotFreqs, freqs)
+        hi = np.clip(hi, segStarts[iSegs]+1, segStarts[iSegs+1]-1)
+        lo = hi - 1
+        xLo = knotFreqs[lo]
+        yLo = knotXs[lo]
+        slope = (knotXs[hi]-yLo)/(knotFreqs[hi]-xLo)
+        return slope*(freqs-xLo) + yLo
+
+class CalibrationSegment():
+    """
+    One segment of a Calibration, called like the interp1d it replaces
+    """
+    def __init__(self, calibration, iSeg):
+        self.calibration = calibration
+        self.iSeg = iSeg
+
+    def __call__(self, freqs):
+        freqs = np.asarray(freqs, dtype=float)
+        return self.calibration.interpolate(freqs, np.full(freqs.shape, self.iSeg))
+
+def saveCalibration(calibration, filename):
+    """
+    Write the calibration to a binary file, read with loadCalibration.
+
+    The file is the magic string, the format version and the length of a JSON header (uint32 little-endian),
+    the JSON header, then the arrays.  The header has the scalar values and the dtype, shape and offset of each
+    array. Arrays are little-endian and aligned on 64 bytes, so they can be memory-mapped on any machine.
+
+    Parameters:
+    -----------
+        calibration : Calibration
+            returned from Scan.makeCalibration, or a calibration dict with a list of interp1d in cInterps
+        filename : str
+            name of the file to write
+    """
+    if not isinstance(calibration, Calibration):
+        calibration = Calibration.fromDict(calibration)
+    fscan = calibration['fscan']
+    arrays = {"fList":calibration['fList'],
+              "knotFreqs":calibration['knotFreqs'],
+              "knotXs":calibration['knotXs'],
+              "segStarts":calibration['segStarts']}
+    for key in ["freqs", "amps", "dfs", "xs"]:
+        arrays["fscan."+key] = fscan[key]
+    scalars = {"fMixer":calibration['fMixer'],
+               "fMin":calibration['fMin'],
+               "fMax":calibration['fMax'],
+               "nominalDelay":calibration['nominalDelay'],
+               "fscan.fMixer":fscan['fMixer'],
+               "fscan.delayApplied":fscan.get('delayApplied')}
+    scalars = {k:(None if v is None else float(v)) for k,v in scalars.items()}
+
+    # Header first, with the offsets relative to the end of the header
+    header = {"scalars":scalars, "arrays":{}}
+    offset = 0
+    for name, a in arrays.items():
+        a = np.asarray(a)
+        dtype = a.dtype.newbyteorder('<') if a.dtype.byteorder != '|' else a.dtype
+        arrays[name] = np.ascontiguousarray(a, dtype=dtype)
+        header['arrays'][name] = {"dtype":dtype.str, "shape":list(a.shape), "offset":offset}
+        offset += -(-arrays[name].nbytes//64)*64
+    headerBytes = json.dumps(header).encode()
+    start = len(CALIBRATION_MAGIC) + 8 + len(headerBytes)
+    headerBytes += b" "*(-start % 64)
+    with open(filename, "wb") as f:
+        f.write(CALIBRATION_MAGIC)
+        f.write(np.array([CALIBRATION_VERSION, len(headerBytes)], dtype='<u4').tobytes())
+        f.write(headerBytes)
+        for name, a in arrays.items():
+            f.write(a.tobytes())
+            f.write(b"\0"*(-a.nbytes % 64))
+
+def loadCalibration(filename):
+    """
+    Read a calibration written by saveCalibration.  The arrays are memory-mapped (read-only):
+    only the pages used are read from the file.
+
+    Parameters:
+    -----------
+        filename : str
+            name of the file to read
+
+    Returns:
+    --------
+        a Calibration
+    """
+    with open(filename, "rb") as f:
+        magic = f.read(len(CALIBRATION_MAGIC))
+        if magic != CALIBRATION_MAGIC:
+            raise ValueError("%s is not a calibration file"%filename)
+        version, headerLength = np.frombuffer(f.read(8), dtype='<u4')
+        if version > CALIBRATION_VERSION:
+            raise ValueError("%s has calibration format version %d, this code reads up to %d"%(
+                filename, version, CALIBRATION_VERSION))
+        header = json.loads(f.read(headerLength))
+    # Map the file once, the arrays are views of it
+    start = len(CALIBRATION_MAGIC) + 8 + int(headerLength)
+    mm = np.memmap(filename, dtype=np.uint8, mode='r')
+    arrays = {}
+    for name, a in header['arrays'].items():
+        dtype = np.dtype(a['dtype'])
+        shape = tuple(a['shape'])
+        offset = start + a['offset']
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        arrays[name] = mm[offset:offset+nbytes].view(dtype).reshape(shape)
+    scalars = header['scalars']
+    fscan = {"fMixer":scalars['fscan.fMixer']}
+    for key in ["freqs", "amps", "dfs", "xs"]:
+        fscan[key] = arrays["fscan."+key]
+    if scalars['fscan.delayApplied'] is not None:
+        fscan['delayApplied'] = scalars['fscan.delayApplied']
+    calibration = Calibration({"fMixer":scalars['fMixer'], "fList":arrays['fList'],
+                               "fMin":scalars['fMin'], "fMax":scalars['fMax'], "fscan":fscan,
+                               "nominalDelay":scalars['nominalDelay'],
+                               "knotFreqs":arrays['knotFreqs'], "knotXs":arrays['knotXs'],
+                               "segStarts":arrays['segStarts']})
+    return calibration
+
 def _unwrapPhis(phis, sign=1):
     """
     Increment (or decrement) values after a large change in phase to unwrap them
@@ -0,0 +1,228 @@
+"""Binary transport of numpy arrays for the Pyro service.
+
+With the pickle serializer, every result of the remote Scan is pickled whole and sent as
+one blob, and unpickling data from another machine can run arbitrary code. Here arrays
+travel as frames: a small header followed by the raw buffer, optionally
+compressed with zlib. Frames are plain bytes, so any Pyro serializer carries them without
+converting the data; ArrayClient uses "marshal", which is fast and safe.
+
+Long results are split along their first axis into frames of at most chunk_bytes, and Pyro
+streams the items of a generator one at a time: the daemon never builds the whole reply,
+and the client processes each chunk as it arrives.
+
+On the board (start_server registers an ArrayService next to the Scan):
+
+    daemon.register(ArrayService(scan))
+
+On the client:
+
+    scan = ArrayClient(Pyro4.Proxy(uri), compress=True)
+    xs = scan.sweep_tones(freqs, fis, gs, None, bandwidth, nf, doProgress=False)
+    for xs in scan.stream_xs(nReads=100):
+        ...
+"""
+import json
+import struct
+import zlib
+import numpy as np
+
+MAGIC = b'MKAR'
+VERSION = 1
+FLAG_ZLIB = 1
+# magic, version, flags, length of the JSON header
+PREFIX = struct.Struct('<4sBBH')
+CHUNK_BYTES = 1 << 24
+
+def pack_array(a, compress=False, level=1):
+    """Packs an array into a frame.
+
+    Parameters
+    ----------
+    a : ndarray
+        the array
+    compress : bool
+        compress the buffer with zlib; kept uncompressed if that is not smaller
+    level : int
+        zlib compression level
+
+    Returns
+    -------
+    bytes
+        the frame
+    """
+    a = np.asarray(a)
+    if a.dtype.hasobject:
+        raise ValueError("cannot pack an array of %s" % a.dtype)
+    if a.dtype.byteorder == '>':
+        a = a.astype(a.dtype.newbyteorder('<'))
+    payload = np.ascontiguousarray(a).data
+    flags = 0
+    if compress:
+        packed = zlib.compress(payload, level)
+        if len(packed) < a.nbytes:
+            payload = packed
+            flags |= FLAG_ZLIB
+    # the full description of the dtype, with the fields of structured arrays
+    header = json.dumps({'descr':np.lib.format.dtype_to_descr(a.dtype), 'shape':a.shape}).encode()
+    return b''.join([PREFIX.pack(MAGIC, VERSION, flags, len(header)), header, payload])
+
+def unpack_array(frame, writable=True):
+    """Unpacks a frame made by pack_array.
+
+    Parameters
+    ----------
+    frame : bytes
+        the frame
+    writable : bool
+        True (default) to return a copy that can be modified,
+        False for a read-only view of the frame, without copying
+
+    Returns
+    -------
+    ndarray
+        the array
+    """
+    magic, version, flags, nHeader = PREFIX.unpack_from(frame)
+    if magic != MAGIC:
+        raise ValueError("not an array frame")
+    if version > VERSION:
+        raise ValueError("array frame version %d, this code reads up to %d" % (version, VERSION))
+    header = json.loads(bytes(frame[PREFIX.size:PREFIX.size+nHeader]))
+    payload = memoryview(frame)[PREFIX.size+nHeader:]
+    if flags & FLAG_ZLIB:
+        payload = zlib.decompress(payload)
+    a = np.frombuffer(payload, dtype=_descr_to_dtype(header['descr'])).reshape(header['shape'])
+    return a.copy() if writable else a
+
+def _descr_to_dtype(descr):
+    return np.lib.format.descr_to_dtype(_descr_from_json(descr))
+
+def _descr_from_json(descr):
+    # JSON turns the tuples of a structured dtype description into lists:
+    # fields are (name or (title, name), descr) or (name, descr, shape).
+    if isinstance(descr, str):
+        return descr
+    fields = []
+    for field in descr:
+        name = tuple(field[0]) if isinstance(field[0], list) else field[0]
+        fields.append((name, _descr_from_json(field[1])) + tuple(tuple(x) for x in field[2:]))
+    return fields
+
+def pack_chunks(a, chunk_bytes=CHUNK_BYTES, compress=False):
+    """Generator of the frames of an array, split along its first axis into frames of at most
+    chunk_bytes (at least one row per frame).
+    """
+    a = np.asarray(a)
+    if a.ndim == 0 or len(a) == 0:
+        yield pack_array(a, compress)
+        return
+    rowBytes = max(a[0].nbytes, 1)
+    nRows = max(chunk_bytes//rowBytes, 1)
+    for i in range(0, len(a), nRows):
+        yield pack_array(a[i:i+nRows], compress)
+
+def unpack_chunks(frames):
+    """Joins the frames made by pack_chunks into one array.
+    """
+    return np.concatenate([unpack_array(frame, writable=False) for frame in frames])
+
+def encode(value, compress=False):
+    """Converts a value for transport: arrays to frames, numpy scalars to python numbers,
+    in lists, tuples and dicts (see decode).
+    """
+    if isinstance(value, np.ndarray):
+        return {'__frame__':pack_array(value, compress)}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, dict):
+        return {k:encode(v, compress) for k,v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(encode(v, compress) for v in value)
+    return value
+
+def decode(value):
+    if isinstance(value, dict):
+        if '__frame__' in value:
+            return unpack_array(value['__frame__'])
+        return {k:decode(v) for k,v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(decode(v) for v in value)
+    return value
+
+class ArrayService():
+    """Server side: calls the methods of an object (the Scan) and returns the results as frames.
+    """
+    def __init__(self, target):
+        self.target = target
+
+    def resolve(self, method):
+        # dotted names reach members, for example "kidsChain.get_xs"
+        obj = self.target
+        for name in method.split('.'):
+            if name.startswith('_'):
+                raise ValueError("%s is private" % method)
+            obj = getattr(obj, name)
+        return obj
+
+    def call(self, method, args=(), kwargs=None, compress=False):
+        """Calls method(*args, **kwargs), arguments and result encoded (see encode).
+        """
+        result = self.resolve(method)(*decode(args), **decode(kwargs or {}))
+        return encode(result, compress)
+
+    def stream(self, method, args=(), kwargs=None, compress=False, chunk_bytes=CHUNK_BYTES):
+        """Calls method(*args, **kwargs), which returns an array, and yields its frames (see pack_chunks).
+        """
+        result = self.resolve(method)(*decode(args), **decode(kwargs or {}))
+        yield from pack_chunks(result, chunk_bytes, compress)
+
+    def stream_xs(self, nReads=None, nPreTruncate=0, compress=False):
+        """Yields one frame per DMA buffer of the time stream of the current tones (see KidsChain.iter_xs).
+        """
+        for xs in self.target.kidsChain.iter_xs(nReads, nPreTruncate):
+            yield pack_array(xs, compress)
+
+class ArrayClient():
+    """Client side: calls the methods of the remote object through its ArrayService.
+
+    Any method is called as scan.method(*args, **kwargs); arrays in the arguments and
+    in the results travel as frames.
+    """
+    def __init__(self, proxy, compress=False, chunk_bytes=CHUNK_BYTES):
+        """
+        Parameters
+        ----------
+        proxy : Pyro4.Proxy
+            proxy of the ArrayService
+        compress : bool
+            compress the results
+        chunk_bytes : int
+            size of the frames of streamed results
+        """
+        self.proxy = proxy
+        self.proxy._pyroSerializer = "marshal"
+        self.compress = compress
+        self.chunk_bytes = chunk_bytes
+
+    def call(self, method, *args, **kwargs):
+        return decode(self.proxy.call(method, encode(args), encode(kwargs), self.compress))
+
+    def stream(self, method, *args, **kwargs):
+        """Generator of the chunks of an array result, received one at a time.
+        """
+        for frame in self.proxy.stream(method, encode(args), encode(kwargs), self.compress, self.chunk_bytes):
+            yield unpack_array(frame)
+
+    def stream_xs(self, nReads=None, nPreTruncate=0):
+        """Generator of the time stream of the current tones, one (nsamp, ntones) array per DMA buffer.
+        """
+        for frame in self.proxy.stream_xs(nReads, nPreTruncate, self.compress):
+            yield unpack_array(frame)
+
+    def _pyroRelease(self):
+        self.proxy._pyroRelease()
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return lambda *args, **kwargs: self.call(name, *args, **kwargs)
@@ -1,6 +1,9 @@
-import psutil, socket
+import psutil, socket, time
+import concurrent.futures
+import numpy as np
 import Pyro4
 import Pyro4.naming
+from array_transport import ArrayService, ArrayClient
 
 ## Open up the Scan library
 import sys
@@ -50,8 +53,11 @@ def start_server(ns_host, ns_port=8888, proxy_name='mkidrfsoc', **kwargs):
     """
     Pyro4.config.REQUIRE_EXPOSE = False
     Pyro4.config.SERIALIZER = "pickle"
-    Pyro4.config.SERIALIZERS_ACCEPTED=set(['pickle'])
+    # marshal is used by the ArrayClient, which sends arrays as raw buffers (see array_transport.py)
+    Pyro4.config.SERIALIZERS_ACCEPTED=set(['pickle', 'marshal'])
     Pyro4.config.PICKLE_PROTOCOL_VERSION=4
+    # a thread per connection: a long transfer to one client does not block the others
+    Pyro4.config.SERVERTYPE = "thread"
 
     print("looking for nameserver . . .")
     ns = Pyro4.locateNS(host=ns_host, port=ns_port)
@@ -76,6 +82,10 @@ def start_server(ns_host, ns_port=8888, proxy_name='mkidrfsoc', **kwargs):
     ns.register(proxy_name, daemon.register(scan))
     print("registered Scan")
 
+    # the same Scan, with arrays sent as raw buffers instead of pickles
+    ns.register(proxy_name+".arrays", daemon.register(ArrayService(scan)))
+    print("registered ArrayService")
+
     # register in the daemon all the objects we expose as properties of the Scan
     # we don't register them in the nameserver, since they are only meant to be accessed through the QickSoc proxy
     # https://pyro4.readthedocs.io/en/stable/servercode.html#autoproxying
@@ -118,4 +128,180 @@ def make_proxy(ns_host, ns_port='8888', proxy_name='mkidrfsoc'):
 
     scan = Pyro4.Proxy(ns.lookup(proxy_name))
     # scancfg = QickConfig(scan.get_cfg())
-    return scan # (scan, scancfg)
\ No newline at end of file
+    return scan # (scan, scancfg)
+
+def make_array_proxy(ns_host, ns_port='8888', proxy_name='mkidrfsoc', compress=False):
+    """Connects to the ArrayService of a Scan proxy server: same methods as the proxy
+    returned by make_proxy(), with arrays sent as raw buffers (see array_transport.py).
+
+    Parameters
+    ----------
+    ns_host : str
+        hostname or IP address of the nameserver
+    ns_port : int
+        the port number you used when starting the nameserver
+    proxy_name : str
+        name for the Scan proxy you used when running start_server()
+    compress : bool
+        compress the arrays sent by the server (with zlib)
+
+    Returns
+    -------
+    ArrayClient
+        client of the Scan
+    """
+    ns = Pyro4.locateNS(host=ns_host, port=ns_port)
+    return ArrayClient(Pyro4.Proxy(ns.lookup(proxy_name+".arrays")), compress=compress)
+
+def make_proxies(ns_host, ns_port='8888', proxy_names=None, arrays=False, compress=False):
+    """Connects to the Scan proxy servers of several boards.
+
+    Parameters
+    ----------
+    ns_host : str
+        hostname or IP address of the nameserver
+    ns_port : int
+        the port number you used when starting the nameserver
+    proxy_names : list of str
+        names used when running start_server() on each board;
+        None (default) for all the servers registered in the nameserver
+    arrays : bool
+        connect to the ArrayService of each board, which sends arrays as raw buffers
+        (see make_array_proxy)
+    compress : bool
+        with arrays, compress the arrays sent by the servers
+
+    Returns
+    -------
+    dict
+        proxy of each board, by proxy name
+    """
+    Pyro4.config.SERIALIZER = "pickle"
+    Pyro4.config.PICKLE_PROTOCOL_VERSION=4
+
+    ns = Pyro4.locateNS(host=ns_host, port=ns_port)
+    uris = ns.list()
+    if proxy_names is None:
+        proxy_names = sorted(name for name in uris
+                             if name != "Pyro.NameServer" and not name.endswith(".arrays"))
+    # one proxy, and so one connection, per board
+    if arrays:
+        return {name:ArrayClient(Pyro4.Proxy(uris[name+".arrays"]), compress=compress) for name in proxy_names}
+    return {name:Pyro4.Proxy(uris[name]) for name in proxy_names}
+
+class MultiScan():
+    """Runs the same Scan call on several boards at once.
+
+    Each board has its own proxy (its own connection) and its own thread, so a call
+    takes as long as the slowest board, not the sum over the boards.
+
+        boards = MultiScan(make_proxies(ns_host, 8888, ['board0', 'board1']))
+        xs, tones = boards.sweep_tones({'board0':(f0, fis0, gs0, None),
+                                        'board1':(f1, fis1, gs1, None)}, bandwidth, nf)
+        boards.timing
+    """
+    def __init__(self, proxies):
+        """
+        Parameters
+        ----------
+        proxies : dict
+            proxy of each board, by name (see make_proxies)
+        """
+        self.proxies = dict(proxies)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(self.proxies))
+        # seconds taken by each board, and in total, in the last call
+        self.timing = {}
+
+    def call(self, method, args=None, kwargs=None, verbose=False):
+        """Calls a method of the Scan of every board concurrently.
+
+        Parameters
+        ----------
+        method : str
+            name of the Scan method
+        args : dict
+            positional arguments (a tuple) for each board, by name; None for no arguments
+        kwargs : dict
+            keyword arguments, the same for every board
+        verbose : bool
+            print the time taken by each board
+
+        Returns
+        -------
+        dict
+            result of each board, by name
+        """
+        if args is None:
+            args = {name:() for name in self.proxies}
+        if kwargs is None:
+            kwargs = {}
+        # Sanity check.
+        unknown = set(args) - set(self.proxies)
+        if unknown:
+            raise ValueError("unknown boards: %s" % sorted(unknown))
+
+        def run(name):
+            t0 = time.perf_counter()
+            result = getattr(self.proxies[name], method)(*args[name], **kwargs)
+            return result, time.perf_counter()-t0
+
+        t0 = time.perf_counter()
+        futures = {name:self.executor.submit(run, name) for name in args}
+        concurrent.futures.wait(futures.values())
+        self.timing = {'total':time.perf_counter()-t0}
+
+        results = {}
+        failed = []
+        for name, future in futures.items():
+            if future.exception() is not None:
+                failed.append(name)
+                continue
+            results[name], self.timing[name] = future.result()
+        if verbose:
+            for name in results:
+                print("%s: %.3f s"%(name, self.timing[name]))
+            print("total: %.3f s"%self.timing['total'])
+        if failed:
+            raise RuntimeError("%s failed on boards %s"%(method, failed)) from futures[failed[0]].exception()
+        return results
+
+    def sweep_tones(self, tones, bandwidth, nf, verbose=False, **kwargs):
+        """Sweeps the tones of every board concurrently (see Scan.sweep_tones).
+
+        Parameters
+        ----------
+        tones : dict
+            (freqs, fis, gs, cgs) of each board, by name
+        bandwidth : float
+            sweep bandwidth, in MHz
+        nf : int
+            number of frequencies in the sweep
+        verbose : bool
+            print the time taken by each board
+        kwargs : optional named arguments
+            passed to Scan.sweep_tones on every board (store is not supported)
+
+        Returns
+        -------
+        xs : ndarray of complex
+            sweeps of all the boards, tones of the boards one after the other on the second index
+        slices : dict
+            the tones of each board, by name: xs[:,slices[name]]
+        """
+        kwargs.setdefault('doProgress', False)
+        args = {name:tuple(tones[name]) + (bandwidth, nf) for name in tones}
+        results = self.call('sweep_tones', args, kwargs, verbose=verbose)
+
+        slices = {}
+        i = 0
+        for name in tones:
+            n = np.shape(results[name])[1]
+            slices[name] = slice(i, i+n)
+            i += n
+        xs = np.concatenate([results[name] for name in tones], axis=1)
+        return xs, slices
+
+    def close(self):
+        self.executor.shutdown()
+        for proxy in self.proxies.values():
+            proxy._pyroRelease()
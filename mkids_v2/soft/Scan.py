@@ -160,7 +160,7 @@ class Scan():
         """ Return the frequency at the center of the output channels"""
         return self.kidsChain.synthesis.ch2freq(outChs)
 
-    def sweep_tones(self, freqs, fis, gs, cgs, bandwidth, nf, doProgress=True, verbose=False, mean=True, nPreTruncate=100, doApplyDelay=True, additionalDelay = 0.0, phiCenter = 0.0, nRepeats=1):
+    def sweep_tones(self, freqs, fis, gs, cgs, bandwidth, nf, doProgress=True, verbose=False, mean=True, nPreTruncate=100, doApplyDelay=True, additionalDelay = 0.0, phiCenter = 0.0, nRepeats=1, plan=None, store=None):
         """
         Perform a frequency sweep of the tones set by set_tones()
                         
@@ -188,24 +188,52 @@ class Scan():
                 calculates the mean value of all samples
             nPreTruncate: int (default=100)
                 number of samples at beginning of read to ignore
+            plan: SweepPlan (default=None)
+                plan from a previous identical scan (self.kidsChain.sweepPlan), to avoid recomputing it
+            store: DataStore (default=None)
+                if given, the sweep is written into the 'xs' dataset of the store instead of
+                being kept in memory.  The delay and phiCenter rotation are then not applied:
+                their values are saved in the store metadata, with the mixer and Nyquist zones.
                 
         Returns:
         --------
-            xs : ndarray of complex doubles
+            xs : ndarray of complex doubles, or the store if one is given
                 first index:  frequency offset value
                 second index: tone number
                 third index (if mean=False): sample number
                 
         """
         self.kidsChain.set_tones(freqs, fis, gs, cgs, verbose)
-        xs = self.kidsChain.sweep_tones(bandwidth, nf, doProgress, verbose, mean, nPreTruncate, nRepeats)
+        if store is not None:
+            store.set_meta(freqs=np.asarray(freqs), nZone=self.nZoneFromFTone(np.asarray(freqs)),
+                           nominalDelay=self.nominalDelay, additionalDelay=additionalDelay,
+                           doApplyDelay=doApplyDelay, phiCenter=phiCenter)
+            return self.kidsChain.sweep_tones(bandwidth, nf, doProgress, verbose, mean, nPreTruncate, nRepeats, plan, store=store)
+        xs = self.kidsChain.sweep_tones(bandwidth, nf, doProgress, verbose, mean, nPreTruncate, nRepeats, plan)
         if doApplyDelay:
             delay = self.nominalDelay + additionalDelay
-            xs = applyDelay(freqs, self.kidsChain.scanFOffsets, xs, delay)
+            xs = applyDelay(freqs, self.kidsChain.scanFOffsets, xs, delay, out=xs)
         if phiCenter is not None:
             iMid = xs.shape[0]//2
             rotPhis = phiCenter - np.angle(xs[iMid,:])
-            xs = rotateTones(xs, rotPhis)
+            xs = rotateTones(xs, rotPhis, inPlace=True)
+        return xs
+
+    async def sweep_tones_async(self, freqs, fis, gs, cgs, bandwidth, nf, verbose=False, mean=True, nPreTruncate=100, doApplyDelay=True, additionalDelay = 0.0, phiCenter = 0.0, nRepeats=1, plan=None):
+        """
+        Same as sweep_tones(), as a coroutine: the event loop runs other tasks
+        (for example, serving remote clients) while each DMA is pending.
+        See KidsChain.sweep_tones_async().
+        """
+        self.kidsChain.set_tones(freqs, fis, gs, cgs, verbose)
+        xs = await self.kidsChain.sweep_tones_async(bandwidth, nf, verbose, mean, nPreTruncate, nRepeats, plan)
+        if doApplyDelay:
+            delay = self.nominalDelay + additionalDelay
+            xs = applyDelay(freqs, self.kidsChain.scanFOffsets, xs, delay, out=xs)
+        if phiCenter is not None:
+            iMid = xs.shape[0]//2
+            rotPhis = phiCenter - np.angle(xs[iMid,:])
+            xs = rotateTones(xs, rotPhis, inPlace=True)
         return xs
 
     def getDelayForOutCh(self, outCh, df=None, N=50, doProgress=False, plotFit=False):
@@ -233,9 +261,9 @@ class Scan():
     
     
     
-def rotateTones(xs, phis):
+def rotateTones(xs, phis, inPlace=False):
     """
-    Rotate each tone by phi, in place
+    Rotate each tone by phi
  
     Parameters:
     -----------
@@ -243,11 +271,13 @@ def rotateTones(xs, phis):
             The second index is the tone number
         phis: 1d nparray of double
             amount to rotate each tone (in Radians)
+        inPlace: boolean
+            True to rotate xs itself, instead of a copy; default=False
             
     Returns:
     --------
-        None
-            The xs values are changed in place
+        xs
+            the rotated values:  a new array, or xs if inPlace is True
     
     Raises:
     -------
@@ -255,8 +285,10 @@ def rotateTones(xs, phis):
             if the second dimension of xs is not the same as the length of phi
     
     """
-    xs = np.abs(xs)*np.exp(1j*(np.angle(xs)+phis))
-    return xs
+    # Sanity check.
+    if np.shape(phis)[0] != xs.shape[1]:
+        raise ValueError("xs has %d tones but %d phases are given" % (xs.shape[1], np.shape(phis)[0]))
+    return rotatePhase(xs, phis, axis=1, out=xs if inPlace else None)
 
 def availableBitfiles():
     """ Return a list of firmware names available. """
@@ -280,7 +312,7 @@ def getBoard():
     board = os.environ["BOARD"].lower().replace("208","216")
     return board
     
-def sweptTonesToSpectrum(sweptTones, fTones, scanFOffsets):
+def sweptTonesToSpectrum(sweptTones, fTones, scanFOffsets, mergeRuns=False):
     """
     Reorganize results of a simulatanous sweep of N tones to frequency,X arrays
     
@@ -292,6 +324,10 @@ def sweptTonesToSpectrum(sweptTones, fTones, scanFOffsets):
             nominal tone frequencies (MHz)
         scanFOffsets:
             offset values applied to sweep
+        mergeRuns: boolean
+            True to merge the (sorted) sweeps of each tone instead of sorting all the values,
+            faster for many tones; values at equal frequencies may be in a different order.
+            Default False
             
     Returns:
     --------
@@ -300,20 +336,28 @@ def sweptTonesToSpectrum(sweptTones, fTones, scanFOffsets):
             X: np array of complex, I,Q values (ADUs)
     
     """
-    nOffset = sweptTones.shape[0]
-    nTones = sweptTones.shape[1]
-    nFreqs = nOffset*nTones
-    freqs = np.zeros(nFreqs)
-    xValues = np.zeros(nFreqs, dtype=complex)
-    i = 0
-    for iTone in range(nTones):
-        for iOffset in range(nOffset):
-            freqs[i] = fTones[iTone] + scanFOffsets[iOffset]
-            xValues[i] = sweptTones[iOffset,iTone]
-            i += 1
-    inds = np.argsort(freqs)
+    freqs, inds = spectrumOrder(fTones, scanFOffsets, mergeRuns)
+    xValues = np.transpose(sweptTones).ravel()
     return freqs[inds],xValues[inds]
 
+def spectrumOrder(fTones, scanFOffsets, mergeRuns=False):
+    """
+    Frequencies of a sweep of N tones, tone by tone (the order of np.transpose(sweptTones).ravel()),
+    and the indices that sort them.
+
+    With mergeRuns, the sweep of each tone (a sorted run) is laid out in the order of the tones and
+    the runs are merged by a stable sort (timsort), which only takes one pass when they do not overlap.
+    """
+    fTones = np.asarray(fTones, dtype=float)
+    scanFOffsets = np.asarray(scanFOffsets, dtype=float)
+    freqs = (fTones[:,np.newaxis] + scanFOffsets).ravel()
+    if not mergeRuns:
+        return freqs, np.argsort(freqs)
+    iTones = np.argsort(fTones, kind='stable')
+    iOffsets = np.argsort(scanFOffsets, kind='stable')
+    runs = (iTones[:,np.newaxis]*len(scanFOffsets) + iOffsets).ravel()
+    return freqs, runs[np.argsort(freqs[runs], kind='stable')]
+
 def bodePlot(f,x, supTitle=None, plotFmt='.-'):
     fig,ax = plt.subplots(2,1,sharex=True)
     ax[0].plot(f,np.abs(x), plotFmt)
@@ -0,0 +1,322 @@
+#!/usr/bin/env python3
+"""
+Benchmarks of the acquisition and sweep hot paths, run on the simulated hardware
+(see simulation.py), so they work without a board.
+
+Covered:
+    * AxisStreamerV1.transfer, transfer_raw, format_data and get_data_all
+    * AxisDdsDualV1.alloff
+    * KidsChain.set_tones, get_xs, sweep_tones and sweep_tones_pipelined
+    * legacy mkids/Scan.unpack, on synthetic packets
+
+Each result reports timing statistics (seconds), rates (steps/s, MB/s decoded) and,
+for the multi-phase calls, the latency of each phase. Results are written as JSON for
+trend tracking.
+
+Usage:
+    python benchmark.py [-o results.json] [-f firmware] [-b board] [-t 1,10,100,1000]
+                        [-n 1000,10000] [-s nf] [-r repeats]
+
+Note that "acquire" phases include the time the simulator takes to generate the data.
+"""
+import sys, getopt, json, time, types, platform, datetime, contextlib
+import importlib.util
+from pathlib import Path
+
+import simulation
+from mkids import *
+import numpy as np
+
+def timeit(fn, repeats=5):
+    """
+    Call fn() repeats times.
+
+    Returns:
+    --------
+        stats : dict
+            number of calls and min/median/mean duration (s)
+        result :
+            value returned by the last call
+    """
+    dts = []
+    for i in range(repeats):
+        t0 = time.perf_counter()
+        result = fn()
+        dts.append(time.perf_counter() - t0)
+    dts = np.array(dts)
+    stats = {'n' : repeats, 'min' : dts.min(), 'median' : np.median(dts), 'mean' : dts.mean()}
+    return stats, result
+
+def phase_stats(phases):
+    """
+    Mean duration (s) of each phase, from a dict of lists of durations.
+    """
+    return {k : float(np.mean(v)) for k,v in phases.items()}
+
+@contextlib.contextmanager
+def timed_methods(obj, names, phases):
+    """
+    Within the context, the duration of each call to the methods of obj in names (dict of
+    method name to phase name) is appended to phases[phase name].
+    """
+    def timed(method, phase):
+        def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return method(*args, **kwargs)
+            finally:
+                phases[phase].append(time.perf_counter() - t0)
+        return wrapper
+
+    for name, phase in names.items():
+        setattr(obj, name, timed(getattr(obj, name), phase))
+    try:
+        yield
+    finally:
+        for name in names:
+            delattr(obj, name)
+
+def result(name, params, stats, rates=None, phases=None):
+    r = {'name' : name, 'params' : params, 'stats' : {k : float(v) for k,v in stats.items()}}
+    if rates is not None:
+        r['rates'] = {k : float(v) for k,v in rates.items()}
+    if phases is not None:
+        r['phases'] = phases
+    return r
+
+def tone_freqs(kids, ntones):
+    """
+    ntones frequencies (MHz) in different PFB channels, spread over the band, near channel centers.
+    """
+    pfb = getattr(kids.soc, kids.synthesis.dict['chain']['pfb'])
+    N  = pfb.dict['N']
+    fc = pfb.dict['freq']['fc']
+    if ntones > 0.98*N:
+        raise ValueError("%d tones do not fit in %d channels" % (ntones, N))
+    step = max(1, int(0.98*N)//ntones)
+    k = (np.arange(ntones) - (ntones-1)/2)*step
+    fmix = kids.synthesis.get_mixer_frequency()
+    return fmix + k*fc + 0.1*fc
+
+def bench_streamer(soc, kids, nsamps, repeats, ntones=100):
+    results = []
+    streamer = getattr(soc, kids.analysis.dict['chain']['streamer'])
+
+    # Tones, so that packets cycle over several transactions.
+    ntones = min(ntones, getattr(soc, kids.synthesis.dict['chain']['pfb']).dict['N']//2)
+    kids.set_tones(tone_freqs(kids, ntones), np.zeros(ntones), 0.9/ntones*np.ones(ntones))
+
+    for nsamp in nsamps:
+        streamer.set(nsamp)
+        params = {'nsamp' : nsamp, 'ntones' : ntones}
+        mb = streamer.buff.nbytes/1e6
+
+        stats, buff = timeit(streamer.transfer_raw, repeats)
+        results.append(result('AxisStreamerV1.transfer_raw', params, stats))
+
+        stats, _ = timeit(lambda: streamer.format_data(buff), repeats)
+        results.append(result('AxisStreamerV1.format_data', params, stats,
+                              rates={'MB/s' : mb/stats['median']}))
+
+        stats, _ = timeit(streamer.get_data_all, repeats)
+        results.append(result('AxisStreamerV1.get_data_all', params, stats,
+                              rates={'MB/s' : mb/stats['median']}))
+
+        stats, _ = timeit(lambda: streamer.transfer(nt=1), repeats)
+        results.append(result('AxisStreamerV1.transfer', params, stats,
+                              rates={'MB/s' : mb/stats['median']}))
+
+    # Back to the default.
+    streamer.set(10000)
+    return results
+
+def bench_alloff(soc, kids, repeats):
+    dds = getattr(soc, kids.synthesis.dict['chain']['dds'])
+    stats, _ = timeit(dds.alloff, repeats)
+    return [result('AxisDdsDualV1.alloff', {'nch' : dds.NCH_TOTAL}, stats)]
+
+def bench_tones(soc, kids, ntones_list, nsamps, nf, repeats):
+    results = []
+    streamer = getattr(soc, kids.analysis.dict['chain']['streamer'])
+    pfb = getattr(soc, kids.synthesis.dict['chain']['pfb'])
+    bandwidth = 0.5*pfb.dict['freq']['fc']
+
+    for ntones in ntones_list:
+        try:
+            freqs = tone_freqs(kids, ntones)
+        except ValueError as e:
+            results.append({'name' : 'KidsChain', 'params' : {'ntones' : ntones}, 'skipped' : str(e)})
+            continue
+        fis = np.zeros(ntones)
+        gs = 0.9/ntones*np.ones(ntones)
+
+        # set_tones: from all off, and again with the same tones.
+        params = {'ntones' : ntones}
+        def set_new():
+            kids.synthesis.alloff()
+            kids.set_tones(freqs, fis, gs)
+        stats, _ = timeit(set_new, repeats)
+        results.append(result('KidsChain.set_tones', params, stats))
+        stats, _ = timeit(lambda: kids.set_tones(freqs, fis, gs), repeats)
+        results.append(result('KidsChain.set_tones (unchanged)', params, stats))
+
+        for nsamp in nsamps:
+            streamer.set(nsamp)
+            params = {'ntones' : ntones, 'nsamp' : nsamp}
+            mb = streamer.buff.nbytes/1e6
+
+            # get_xs(mean=True), timed stage by stage, so the stats and the phases come from the same calls.
+            phases = {'acquire' : [], 'decode' : [], 'extract' : []}
+            def get_xs():
+                t0 = time.perf_counter()
+                buff = streamer.transfer_raw()
+                t1 = time.perf_counter()
+                iq, idx = streamer.decode(buff)
+                t2 = time.perf_counter()
+                reducer = MeanReducer()
+                reducer.add(ToneSamples(iq, idx, kids.ntrans, kids.idxs))
+                xs = list(reducer.result()['mean'])
+                t3 = time.perf_counter()
+                phases['acquire'].append(t1-t0)
+                phases['decode'].append(t2-t1)
+                phases['extract'].append(t3-t2)
+                return xs
+            stats, _ = timeit(get_xs, repeats)
+            results.append(result('KidsChain.get_xs', params, stats,
+                                  rates={'MB/s' : mb/stats['median']},
+                                  phases=phase_stats(phases)))
+
+            # sweep_tones, with the phases of each step measured in the same calls.
+            phases = {'program' : [], 'enable' : [], 'read' : []}
+            steps = {'apply_sweep_step' : 'program', 'enable_channels' : 'enable', 'get_xs' : 'read'}
+            with timed_methods(kids, steps, phases):
+                stats, _ = timeit(lambda: kids.sweep_tones(bandwidth, nf, doProgress=False,
+                                                            nPreTruncate=0), repeats)
+            params = {'ntones' : ntones, 'nsamp' : nsamp, 'nf' : nf}
+            # Planning and everything outside the steps, per sweep (the other phases are per step).
+            other = stats['mean'] - sum(np.sum(v) for v in phases.values())/repeats
+            results.append(result('KidsChain.sweep_tones', params, stats,
+                                  rates={'steps/s' : nf/stats['median'], 'MB/s' : nf*mb/stats['median']},
+                                  phases=dict(phase_stats(phases), **{'other (per sweep)' : float(other)})))
+            kids.set_tones(freqs, fis, gs)
+
+            stats, _ = timeit(lambda: kids.sweep_tones_pipelined(bandwidth, nf, doProgress=False,
+                                                                  nPreTruncate=0), repeats)
+            results.append(result('KidsChain.sweep_tones_pipelined', params, stats,
+                                  rates={'steps/s' : nf/stats['median'], 'MB/s' : nf*mb/stats['median']}))
+            kids.set_tones(freqs, fis, gs)
+
+    streamer.set(10000)
+    return results
+
+def legacy_scan():
+    """
+    Load mkids/Scan.py (legacy firmware), which has the same module name as this Scan.py.
+    """
+    path = Path(__file__).resolve().parents[2].joinpath('mkids', 'Scan.py')
+    spec = importlib.util.spec_from_file_location('legacy_scan', path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def bench_legacy_unpack(ntones_list, nsamps, repeats, nt=1, L=8, nch=4096):
+    results = []
+    legacy = legacy_scan()
+    rng = np.random.default_rng(0)
+
+    for ntones in ntones_list:
+        # Tones on different channels, read in the order of their transactions.
+        chs = np.sort(rng.choice(nch, size=ntones, replace=False))
+        ntrans = np.unique(chs//L)
+
+        scan = legacy.Scan(types.SimpleNamespace(nZone=1))
+        scan.ntranByTone = chs//L
+        scan.streamByTone = chs % L
+        scan.toneFis = np.zeros(ntones)
+
+        for nsamp in nsamps:
+            packets = rng.integers(-2**15, 2**15, size=(nt, nsamp, 2*L+1), dtype=np.int16)
+            packets[:,:,2*L] = ntrans[np.arange(nsamp) % len(ntrans)]
+            scan.packets = packets
+            mb = packets.nbytes/1e6
+            params = {'ntones' : ntones, 'nsamp' : nsamp, 'nt' : nt}
+
+            for average in [True, False]:
+                stats, _ = timeit(lambda: scan.unpack(False, average), repeats)
+                results.append(result('mkids/Scan.unpack (average=%s)' % average, params, stats,
+                                      rates={'MB/s' : mb/stats['median']}))
+
+    return results
+
+def run(firmware='mkids_2x2_kidsim_v1', board='zcu216', ntones=[1, 10, 100, 1000], nsamps=[1000, 10000], nf=20, repeats=5):
+    """
+    Run all benchmarks on a simulated board.
+
+    Returns:
+    --------
+        report : dict
+            'meta' (environment and settings) and 'results' (list of benchmark results)
+    """
+    soc = simulation.SimMkidsSoc(firmware, board=board, seed=0)
+    kids = KidsChain(soc, dual=soc['dual'][0])
+    kids.set_mixer_frequency(1000)
+
+    results = []
+    results += bench_streamer(soc, kids, nsamps, repeats)
+    results += bench_alloff(soc, kids, repeats)
+    results += bench_tones(soc, kids, ntones, nsamps, nf, repeats)
+    results += bench_legacy_unpack(ntones, nsamps, repeats)
+
+    meta = {'date'     : datetime.datetime.now().isoformat(timespec='seconds'),
+            'host'     : platform.node(),
+            'python'   : platform.python_version(),
+            'numpy'    : np.__version__,
+            'firmware' : firmware,
+            'board'    : board,
+            'ntones'   : list(ntones),
+            'nsamps'   : list(nsamps),
+            'nf'       : nf,
+            'repeats'  : repeats}
+
+    return {'meta' : meta, 'results' : results}
+
+if __name__ == '__main__':
+    out = None
+    kwargs = {}
+
+    options, remainder = getopt.gnu_getopt(sys.argv[1:], 'o:f:b:t:n:s:r:h')
+    for opt, arg in options:
+        if opt == '-o':
+            out = arg
+        elif opt == '-f':
+            kwargs['firmware'] = arg
+        elif opt == '-b':
+            kwargs['board'] = arg
+        elif opt == '-t':
+            kwargs['ntones'] = [int(a) for a in arg.split(',')]
+        elif opt == '-n':
+            kwargs['nsamps'] = [int(a) for a in arg.split(',')]
+        elif opt == '-s':
+            kwargs['nf'] = int(arg)
+        elif opt == '-r':
+            kwargs['repeats'] = int(arg)
+        elif opt == '-h':
+            print("\nUsage: "+sys.argv[0]+" [options]")
+            print("Arguments: ")
+            print("\t-o: output JSON file (default stdout)")
+            print("\t-f: firmware (default mkids_2x2_kidsim_v1)")
+            print("\t-b: board (default zcu216)")
+            print("\t-t: comma-separated tone counts (default 1,10,100,1000)")
+            print("\t-n: comma-separated nsamp values (default 1000,10000)")
+            print("\t-s: sweep steps (default 20)")
+            print("\t-r: repeats (default 5)")
+            print("\t-h: this message")
+            print("\n")
+            sys.exit(0)
+
+    report = run(**kwargs)
+    if out is None:
+        print(json.dumps(report, indent=1))
+    else:
+        with open(out, 'w') as f:
+            json.dump(report, f, indent=1)
@@ -427,9 +427,25 @@ class AxisDdsDualV1(SocIp):
         self.NCH    = int(description['parameters']['NCH'])
         self.NCH_TOTAL = self.L * self.NCH
 
+        # Last value written to each configuration register. The IP copies these registers into
+        # the channel selected by addr_nchan_reg only on the WE pulse, and they keep their value in
+        # between, so writes of an unchanged value can be skipped. They are unknown until first
+        # written (the bitstream may not have been reloaded since a previous session), so the first
+        # write of each register always happens.
+        self.staging = {'addr_nchan_reg'     : None,
+                        'addr_pinc_reg'      : None,
+                        'addr_phase_reg'     : None,
+                        'addr_dds_gain_reg'  : None,
+                        'addr_comp_gain_reg' : None,
+                        'addr_cfg_reg'       : None}
+
+        # Shadow copy of the configuration of each channel, as written to hardware.
+        self.shadow = {}
+        for k in ['pinc', 'phase', 'gain', 'cgain', 'cfg']:
+            self.shadow[k] = np.zeros(self.NCH_TOTAL, dtype=np.int64)
+
         # Initialize DDSs.
-        for i in range(self.NCH_TOTAL):
-            self.ddscfg(ch = i)
+        self.alloff()
 
         # Start DDS.
         self.start()
@@ -450,67 +466,165 @@ class AxisDdsDualV1(SocIp):
     def ddscfg(self, f=0, fi=0, g=0, cg=0, ch=0, comp=False, verbose=False):
         if verbose: print("dds.py  AxisDdsDualV1 ddscfg:  f, fi, g, ch, comp=",f,fi,g,ch,comp)
 
+        self.ddscfg_many(f, fi, g, cg, ch, comp=comp)
+
+    def ddscfg_many(self, freqs=0, phases=0, gains=0, cgs=0, chs=0, comp=False, verbose=False):
+        """
+        Configure several DDS channels at once.
+
+        Parameters:
+        -----------
+            freqs : float or array of floats
+                DDS frequency (Hz)
+            phases : float or array of floats
+                DDS phase (degrees)
+            gains : float or array of floats
+                DDS gain, in [-1,1)
+            cgs : complex or array of complex, or None
+                compensation gain, real and imaginary parts in [-1,1)
+            chs : int or array of ints
+                channel numbers
+            comp : boolean
+                apply compensation gain
+
+        Raises:
+        -------
+            ValueError
+                if any of the values is out of range. Nothing is written in that case.
+        """
+        words = self.ddscfg_words(freqs, phases, gains, cgs, chs, comp=comp)
+        if verbose:
+            print("dds.py AxisDdsDualV1 ddscfg_many: words =", words)
+
+        self.write_words(words)
+
+    def ddscfg_words(self, freqs=0, phases=0, gains=0, cgs=0, chs=0, comp=False):
+        """
+        Check ranges and quantize DDS settings into register words.
+
+        Arguments are the same as for ddscfg_many(). Scalars are broadcast.
+
+        Returns:
+        --------
+            words : dict of ndarrays of np.int64
+                'ch', 'pinc', 'phase', 'gain', 'cgain' and 'cfg' values of each channel
+        """
+        if cgs is None:
+            cgs = 0
+        f, fi, g, cg, ch = np.broadcast_arrays(np.atleast_1d(freqs), phases, gains, cgs, chs)
+
         # Real/Imaginary part of compensation gain.
         cg_i = np.real(cg)
         cg_q = np.imag(cg)
 
         # Sanity check.
-        if (ch >= 0 and ch < self.NCH_TOTAL):
-            if (f >= -self.FS_DDS/2 and f < self.FS_DDS/2):
-                if (fi >= self.MIN_PHI and fi < self.MAX_PHI): 
-                    if (g >= self.MIN_GAIN and g < self.MAX_GAIN):
-                        if (cg_i >= self.MIN_GAIN and cg_i < self.MAX_GAIN):
-                            if (cg_q >= self.MIN_GAIN and cg_q < self.MAX_GAIN):
-                                # Compute pinc value.
-                                ki = int(round(f/self.DF_DDS))
-
-                                # Compute phase value.
-                                fik = int(round(fi/self.DFI_DDS))
-
-                                # Compute gain.
-                                gi  = g*(2**(self.B_GAIN-1))
-
-                                # Compute compensation gain.
-                                cg_i_int = cg_i*(2**(self.B_GAIN-1))
-                                cg_q_int = cg_q*(2**(self.B_GAIN-1))
-                                cg_int = cg_i_int + (2**self.B_GAIN)*cg_q_int
-
-                                # Output selection.
-                                if self.sel_default == "product":
-                                    cfg = 0
-                                elif self.sel_default == "dds":
-                                    cfg = 1
-                                elif self.sel_default == "input":
-                                    cfg = 2
-                                else:
-                                    cfg = 3 # 0 value.
-
-                                # Compensation.
-                                if not comp:
-                                    cfg += 4
-
-                                self.addr_cfg_reg = 0
-
-
-                                # Write values to hardware.
-                                self.addr_nchan_reg     = ch
-                                self.addr_pinc_reg      = ki
-                                self.addr_phase_reg     = fik
-                                self.addr_dds_gain_reg  = gi
-                                self.addr_comp_gain_reg = cg_int
-                                self.addr_cfg_reg       = cfg
-                                self.addr_we_reg    = 1
-                                self.addr_we_reg    = 0
-                    else:
-                        raise ValueError('gain=%f not contained in [%f,%f)'%(g,self.MIN_GAIN,self.MAX_GAIN))
-                else:
-                    raise ValueError('phase=%f not contained in [%f,%f)'%(fi,self.MIN_PHI,self.MAX_PHI))
-            else:
-                raise ValueError('frequency=%f not contained in [%f,%f)'%(f,0,self.FS_DDS))
+        bad = (ch < 0) | (ch >= self.NCH_TOTAL)
+        if np.any(bad):
+            raise ValueError('ch=%s not contained in [%d,%d)'%(ch[bad],0,self.NCH_TOTAL))
+        bad = (f < -self.FS_DDS/2) | (f >= self.FS_DDS/2)
+        if np.any(bad):
+            raise ValueError('frequency=%s not contained in [%f,%f)'%(f[bad],-self.FS_DDS/2,self.FS_DDS/2))
+        bad = (fi < self.MIN_PHI) | (fi >= self.MAX_PHI)
+        if np.any(bad):
+            raise ValueError('phase=%s not contained in [%f,%f)'%(fi[bad],self.MIN_PHI,self.MAX_PHI))
+        for name,v in zip(['gain', 'compensation gain (real)', 'compensation gain (imag)'], [g, cg_i, cg_q]):
+            bad = (v < self.MIN_GAIN) | (v >= self.MAX_GAIN)
+            if np.any(bad):
+                raise ValueError('%s=%s not contained in [%f,%f)'%(name,v[bad],self.MIN_GAIN,self.MAX_GAIN))
+
+        # Output selection.
+        if self.sel_default == "product":
+            cfg = 0
+        elif self.sel_default == "dds":
+            cfg = 1
+        elif self.sel_default == "input":
+            cfg = 2
         else:
-            raise ValueError('ch=%d not contained in [%d,%d)'%(ch,0,self.NCH_TOTAL))
-            
-    def alloff(self):
-        for ch in np.arange(self.NCH_TOTAL):
-            self.ddscfg(ch=ch) # WIll zero-out output and down-convert with 0 freq.
+            cfg = 3 # 0 value.
+
+        # Compensation.
+        if not comp:
+            cfg += 4
+
+        words = {}
+        words['ch']    = ch.astype(np.int64)
+
+        # Compute pinc value.
+        words['pinc']  = np.round(f/self.DF_DDS).astype(np.int64)
+
+        # Compute phase value.
+        words['phase'] = np.round(fi/self.DFI_DDS).astype(np.int64)
+
+        # Compute gain.
+        words['gain']  = (g*(2**(self.B_GAIN-1))).astype(np.int64)
+
+        # Compute compensation gain.
+        cg_i_int = (cg_i*(2**(self.B_GAIN-1))).astype(np.int64)
+        cg_q_int = (cg_q*(2**(self.B_GAIN-1))).astype(np.int64)
+        words['cgain'] = cg_i_int + (2**self.B_GAIN)*cg_q_int
+
+        words['cfg']   = np.full(len(words['ch']), cfg, dtype=np.int64)
+
+        return words
+
+    def ddscfg_update(self, freqs=0, phases=0, gains=0, cgs=0, chs=0, comp=False, verbose=False):
+        """
+        Configure the given channels and switch off all the others, writing only the channels
+        whose configuration differs from the shadow copy of the hardware state.
+
+        Arguments are the same as for ddscfg_many(). When a tone moves within the same channel,
+        only its phase increment register is written.
+        """
+        words = self.ddscfg_words(freqs, phases, gains, cgs, chs, comp=comp)
+        if verbose:
+            print("dds.py AxisDdsDualV1 ddscfg_update: words =", words)
+
+        self.update_words(words)
+
+    def update_words(self, words):
+        """
+        Write already quantized words (see ddscfg_words()) for the given channels, switch off all
+        the others, and skip channels whose shadow copy already matches.
+        """
+        # Start from all channels off and place the requested ones.
+        full = self.ddscfg_words(chs=np.arange(self.NCH_TOTAL))
+        for k in full:
+            full[k][words['ch']] = words[k]
+
+        self.write_words(full, changed_only=True)
+
+    def write_words(self, words, changed_only=False):
+        """
+        Write quantized DDS words into hardware, one channel at a time.
+        Configuration registers already holding the required value are not written again.
+        If changed_only is True, channels whose shadow copy already matches are skipped.
+        """
+        fields = ['pinc', 'phase', 'gain', 'cgain', 'cfg']
+        if changed_only:
+            chs = words['ch']
+            mask = np.zeros(len(chs), dtype=bool)
+            for k in fields:
+                mask |= self.shadow[k][chs] != words[k]
+            words = {k : v[mask] for k,v in words.items()}
+
+        regs = ['addr_nchan_reg', 'addr_pinc_reg', 'addr_phase_reg', 'addr_dds_gain_reg', 'addr_comp_gain_reg', 'addr_cfg_reg']
+        cols = [words[k].tolist() for k in ['ch', 'pinc', 'phase', 'gain', 'cgain', 'cfg']]
+
+        staging = self.staging
+        for values in zip(*cols):
+            for reg,v in zip(regs,values):
+                if staging[reg] != v:
+                    setattr(self, reg, v)
+                    staging[reg] = v
+
+            # Write values to hardware.
+            self.addr_we_reg    = 1
+            self.addr_we_reg    = 0
+
+        # Update shadow copy.
+        for k in fields:
+            self.shadow[k][words['ch']] = words[k]
 
+    def alloff(self):
+        # WIll zero-out output and down-convert with 0 freq.
+        self.ddscfg_many(chs=np.arange(self.NCH_TOTAL))
@@ -119,6 +119,58 @@ class AxisChSelPfbV2(SocIp):
                 self.we_reg = 1
                 self.we_reg = 0
             
+    def apply_mask(self, chs, verbose=False):
+        """
+        Enable exactly the transactions of the given channels. dict['addr'] is the shadow
+        of the mask words in the block: only words that differ from it are written.
+
+        Parameters:
+        -----------
+            chs : array of int
+                channel numbers
+            verbose : bool
+                True to print the mask words written
+        """
+        chs = np.atleast_1d(chs).astype(int)
+
+        # Sanity check.
+        if np.any(chs < 0) or np.any(chs >= self.NCH):
+            raise ValueError("%s: channel must be within [0,%d]" %(self.fullpath, self.NCH-1))
+
+        # Transactions and mask words.
+        ntran = np.unique(chs//self.L)
+        new = np.zeros(self.NM, dtype=np.uint32)
+        np.bitwise_or.at(new, ntran//32, np.left_shift(np.uint32(1), (ntran%32).astype(np.uint32)))
+        old = np.array(self.dict['addr'], dtype=np.uint32)
+
+        # Write changed words.
+        for addr in np.nonzero(new ^ old)[0]:
+            if verbose:
+                print("{}: addr = {}, Original Mask: {}, Updated Mask: {}".format(self.fullpath, addr, old[addr], new[addr]))
+            self.addr_reg = int(addr)
+            self.data_reg = int(new[addr])
+            self.we_reg = 1
+            self.we_reg = 0
+
+        # Update dictionary.
+        self.dict['addr'] = [int(w) for w in new]
+        self.dict['tran'] = ntran
+        self.dict['chan'] = (self.L*ntran[:,None] + np.arange(self.L)).ravel()
+
+    def set_many(self, chs, verbose=False):
+        """
+        Unmask the transactions of several channels at once, without masking previously
+        enabled channels. Each mask word that changes is written once.
+
+        Parameters:
+        -----------
+            chs : array of int
+                channel numbers
+            verbose : bool
+                True to print the mask words written
+        """
+        self.apply_mask(np.append(self.dict['chan'], chs), verbose=verbose)
+
     def set_single(self,ch):
         self.alloff()
         self.set(ch)
@@ -243,6 +295,57 @@ class AxisChSelPfbV3(SocIp):
                 self.stop()
                 self.start()
             
+    def apply_mask(self, chs, verbose=False):
+        """
+        Enable exactly the transactions of the given channels. dict['punct'] is the shadow
+        of the mask register: it is only written if the mask changes.
+
+        Parameters:
+        -----------
+            chs : array of int
+                channel numbers
+            verbose : bool
+                True to print the mask written
+        """
+        chs = np.atleast_1d(chs).astype(int)
+
+        # Sanity check.
+        if np.any(chs < 0) or np.any(chs >= self.NCH):
+            raise ValueError("%s: channel must be within [0,%d]" %(self.fullpath, self.NCH-1))
+
+        # Data Mask, NT bits wide.
+        ntran = np.unique(chs//self.L)
+        bits = np.left_shift(np.uint64(1), ntran.astype(np.uint64))
+        data = int(np.bitwise_or.reduce(bits, initial=np.uint64(0))) & ((1 << self.NT) - 1)
+
+        # Update dictionary.
+        old = self.dict['punct']
+        self.dict['punct'] = data
+        self.dict['tran'] = ntran
+        self.dict['chan'] = (self.L*ntran[:,None] + np.arange(self.L)).ravel()
+
+        # Write Value.
+        if data != old:
+            if verbose:
+                print("{}: Original Mask: {}, Updated Mask: {}".format(self.fullpath, old, data))
+            self.punct_reg = data
+            self.stop()
+            self.start()
+
+    def set_many(self, chs, verbose=False):
+        """
+        Unmask the transactions of several channels at once, without masking previously
+        enabled channels. The mask is written once.
+
+        Parameters:
+        -----------
+            chs : array of int
+                channel numbers
+            verbose : bool
+                True to print the mask written
+        """
+        self.apply_mask(np.append(self.dict['chan'], chs), verbose=verbose)
+
     def set_single(self,ch):
         self.alloff()
         self.set(ch)
@@ -300,10 +403,19 @@ class AxisStreamerV1(SocIp):
         
         # Number of total samples per transaction.
         self.NS_NI = self.NS + self.NI
-        
+
+        # Transaction layout, used to decode the DMA buffer without copies:
+        # I/Q samples, transaction index, zero padding.
+        self.PACKET_DTYPE = np.dtype([('iq' , np.int16, (self.NS,)),
+                                      ('idx', np.int16),
+                                      ('pad', np.int16, (self.NS_TR-self.NS_NI,))])
+
+        # Extra DMA buffers for streaming (allocated on demand).
+        self.buffs = []
+
     def configure(self,axi_dma):
         self.dma = axi_dma
-    
+
     def stop(self):
         self.start_reg = 0
 
@@ -315,11 +427,74 @@ class AxisStreamerV1(SocIp):
         self.nsamp_reg  = nsamp
         nbuf = nsamp*self.NS_TR
         self.buff = allocate(shape=(nbuf,), dtype=np.int16)
-        
+
+        # Streaming buffers must be re-allocated with the new size.
+        self.buffs = [self.buff]
+
         # Update register value.
         self.stop()
         self.start()
-        
+
+    def stream_buffers(self, nbuffers=2):
+        """
+        Return a list of nbuffers DMA buffers of the current size. The first one is self.buff.
+        Buffers are kept between calls, as DMA-able memory is a limited resource.
+        """
+        while len(self.buffs) < nbuffers:
+            self.buffs.append(allocate(shape=self.buff.shape, dtype=self.buff.dtype))
+
+        return self.buffs[:nbuffers]
+
+    def stream(self, nt=None, nbuffers=2):
+        """
+        Continuously acquire packets, rotating over several pre-allocated DMA buffers.
+
+        The DMA for the next packet is started before the previous one is handed to
+        the caller, so the hardware keeps filling a buffer while Python processes data.
+
+        Parameters:
+        -----------
+            nt : int or None
+                number of packets to acquire, None to stream until the generator is closed
+            nbuffers : int
+                number of DMA buffers in rotation (default 2, ping-pong)
+
+        Yields:
+        -------
+            packets : ndarray of int16
+                (nsamp, NS_NI) view of the DMA buffer that just completed. The buffer is re-used
+                nbuffers-1 packets later, so copy the data if it must be kept longer.
+        """
+        if nbuffers < 2:
+            raise ValueError("%s: streaming needs at least 2 buffers" % self.fullpath)
+
+        buffs = self.stream_buffers(nbuffers)
+        nsamp = self.nsamp_reg
+
+        # Start first DMA.
+        self.dma.recvchannel.transfer(buffs[0])
+        pending = True
+
+        i = 0
+        try:
+            while nt is None or i < nt:
+                # Wait for current DMA.
+                self.dma.recvchannel.wait()
+                pending = False
+                done = buffs[i % nbuffers]
+                i += 1
+
+                # Start next DMA before handing out the data.
+                if nt is None or i < nt:
+                    self.dma.recvchannel.transfer(buffs[i % nbuffers])
+                    pending = True
+
+                yield done.reshape((nsamp, -1))[:,:self.NS_NI]
+        finally:
+            # Leave the DMA channel idle if the generator is closed early.
+            if pending:
+                self.dma.recvchannel.wait()
+
     def transfer_raw(self):
         # DMA data.
         self.dma.recvchannel.transfer(self.buff)
@@ -368,50 +543,103 @@ class AxisStreamerV1(SocIp):
         if verbose:
             print("misc.py start get_data_all")
             
-        packets = self.transfer()
+        buff = self.transfer_raw()
         if verbose:
-            print("misc.py packets.shape =",packets.shape)
+            print("misc.py buff.shape =",buff.shape)
+
+        return self.format_data(buff, verbose=verbose)
+
+    def decode(self, buff):
+        """
+        Decode a DMA buffer into I/Q samples and transaction index, without copying data.
+
+        Parameters:
+        -----------
+            buff : ndarray of int16
+                DMA buffer (or a copy of it)
+
+        Returns:
+        --------
+            iq : ndarray of int16
+                (nsamp, NS) view with interleaved I,Q samples of each transaction
+            idx : ndarray of int16
+                (nsamp,) view with the transaction index
+        """
+        packets = np.asarray(buff).view(self.PACKET_DTYPE)
+        return packets['iq'], packets['idx']
+
+    def format_data(self, buff, verbose=False):
+        """
+        Group the samples of a DMA buffer per transaction index.
+
+        Samples are kept as int16. A single stable sort plus a bincount is used to group
+        them, so the only copy made is the gather of the sorted samples.
+
+        Returns:
+        --------
+            data : dict
+                'raw'     : (NS, nsamp) view of the buffer samples
+                'idx'     : (nsamp,) view of the buffer transaction index
+                'samples' : dict of (NS, n) arrays, indexed by transaction number
+                'raw' and 'idx' point to the DMA buffer and are overwritten by the next transfer.
+        """
+        iq, idx = self.decode(buff)
 
         # Format data.
-        data = {'raw' : [], 'idx' : [], 'samples' : {}}
-
-        # Raw packets.
-        data['raw'] = packets[:,:,:self.NS].reshape((-1,self.NS)).T
-
-        # Active transactions.
-        data['idx']     = packets[:,:,-1].reshape(-1).astype(int)
+        data = {'raw' : iq.T, 'idx' : idx, 'samples' : {}}
 
         # Group samples per transaction index.
-        unique_idx = np.unique(data['idx'])
-        for i in unique_idx:
-            idx = np.argwhere(data['idx'] == i).reshape(-1)
-            data['samples'][i] = data['raw'][:,idx]
+        order   = np.argsort(idx, kind='stable')
+        grouped = iq[order].T
+        counts  = np.bincount(idx.astype(np.intp))
+        starts  = np.concatenate(([0], np.cumsum(counts)[:-1]))
+        for i in np.flatnonzero(counts):
+            data['samples'][i] = grouped[:,starts[i]:starts[i]+counts[i]]
         if verbose:
             for key in data['samples']:
                 print(" data[%d].shape = %s"%(key,data['samples'][key].shape))
  
         return data
 
-
-    def format_data(self, data):
-        unique_idx = np.unique(data['idx'])
-
-        for i in unique_idx:
-            idx = np.argwhere(data['idx'] == i).reshape(-1)
-            samples[i] = data['samples'][:,idx]
-
-        return samples
-
-    async def transfer_async(self):
-        # DMA data.
-        self.dma.recvchannel.transfer(self.buff)
+    def transfer_start(self, buff=None):
+        """
+        Start a DMA into buff (default self.buff) and return it, without waiting.
+        The caller must await transfer_wait_async() (or call dma.recvchannel.wait())
+        before using the buffer or starting another transfer.
+        """
+        if buff is None:
+            buff = self.buff
+        self.dma.recvchannel.transfer(buff)
+        return buff
+
+    async def transfer_wait_async(self):
+        """
+        Wait for the DMA started by transfer_start(), letting the event loop run meanwhile.
+        """
         await self.dma.recvchannel.wait_async()
 
-        # Format data.
-        data = self.buff & 0xFFFFF;
-        indx = (self.buff >> 24) & 0xFF;
+    async def transfer_async(self, buff=None):
+        """
+        Same as transfer_raw(), awaiting the DMA instead of blocking.
+
+        Returns:
+        --------
+            buff : ndarray of int16
+                the DMA buffer, to be decoded with decode() or format_data()
+        """
+        buff = self.transfer_start(buff)
+        await self.transfer_wait_async()
+        return buff
+
+    async def get_data_all_async(self, verbose=False):
+        """
+        Same as get_data_all(), awaiting the DMA instead of blocking.
+        """
+        buff = await self.transfer_async()
+        if verbose:
+            print("misc.py buff.shape =",buff.shape)
 
-        return [indx,data]
+        return self.format_data(buff, verbose=verbose)
 
 class AxisKidsimV3(SocIp):
     bindto = ['user.org:user:axis_kidsim_v3:1.0']
@@ -26,6 +26,11 @@ class AbsPfbAnalysis(SocIp):
 
         # Add data into dictionary.
         self.dict['freq'] = {'fs' : fs, 'fc' : fc, 'fb' : fb}
+
+        # Channel-center table (MHz), used by ch2freq_fast().
+        N = self.dict['N']
+        self.ch_freqs = fc*np.arange(N)
+        self.ch_freqs[N//2:] -= N*fc
     
     def configure_connections(self, soc):
         self.soc = soc
@@ -261,13 +266,14 @@ class AbsPfbAnalysis(SocIp):
         if np.any(abs(f) > fMax):
                     raise ValueError("Frequency value %s out of allowed range [%f,%f]" % (str(f),-fMax, fMax))
 
-        k = np.round(f/self.dict['freq']['fc']).astype(int)
-        if isinstance(k,np.int64):
-            if k < 0:
-                k += self.dict['N']
-        else:
-            k[k<0] += self.dict['N']
-        return k
+        return self.freq2ch_fast(f)
+
+    def freq2ch_fast(self, f):
+        """
+        Same as freq2ch(), without input checks: f must be a float or numpy array
+        within +/- fs/2. Meant for loops where the range was checked beforehand.
+        """
+        return np.rint(np.divide(f, self.dict['freq']['fc'])).astype(int) % self.dict['N']
     
     def ch2freq(self,ch):
         """
@@ -295,16 +301,14 @@ class AbsPfbAnalysis(SocIp):
         if np.any(ch < 0) or np.any(ch >= N):
                     raise ValueError("Channel value %s out of allowed range [0,%d)" % (str(ch),N))
       
-        fc = self.dict['freq']['fc']
-        freq = ch*fc
-        
-        if isinstance(ch, int) or isinstance(ch, np.int64):
-            if ch >= N//2: 
-                freq -= N*fc
-        else:           
-            freq = ch*fc
-            freq[ch >= N//2] -= N*fc
-        return freq
+        return self.ch2freq_fast(ch)
+
+    def ch2freq_fast(self, ch):
+        """
+        Same as ch2freq(), without input checks: ch must be an int or numpy array
+        of ints within [0,N). Looks up the channel-center table.
+        """
+        return self.ch_freqs[ch]
             
     def qout(self, qout):
         self.qout_reg = qout
@@ -352,6 +356,11 @@ class AbsPfbSynthesis(SocIp):
 
         # Add data into dictionary.
         self.dict['freq'] = {'fs' : fs, 'fc' : fc, 'fb' : fb}
+
+        # Channel-center table (MHz), used by ch2freq_fast().
+        N = self.dict['N']
+        self.ch_freqs = fc*np.arange(N)
+        self.ch_freqs[N//2:] -= N*fc
     
     def configure_connections(self, soc):
         self.soc = soc
@@ -539,13 +548,14 @@ class AbsPfbSynthesis(SocIp):
         if np.any(abs(f) > fMax):
                     raise ValueError("Frequency value %s out of allowed range [%f,%f]" % (str(f),-fMax, fMax))
 
-        k = np.round(f/self.dict['freq']['fc']).astype(int)
-        if isinstance(k,np.int64):
-            if k < 0:
-                k += self.dict['N']
-        else:
-            k[k<0] += self.dict['N']
-        return k
+        return self.freq2ch_fast(f)
+
+    def freq2ch_fast(self, f):
+        """
+        Same as freq2ch(), without input checks: f must be a float or numpy array
+        within +/- fs/2. Meant for loops where the range was checked beforehand.
+        """
+        return np.rint(np.divide(f, self.dict['freq']['fc'])).astype(int) % self.dict['N']
 
     def ch2freq(self,ch):
         """
@@ -574,16 +584,14 @@ class AbsPfbSynthesis(SocIp):
         if np.any(ch < 0) or np.any(ch >= N):
                     raise ValueError("Channel value %s out of allowed range [0,%d)" % (str(ch),N))
       
-        fc = self.dict['freq']['fc']
-        freq = ch*fc
-        
-        if isinstance(ch, int) or isinstance(ch, np.int64):
-            if ch >= N//2: 
-                freq -= N*fc
-        else:           
-            freq = ch*fc
-            freq[ch >= N//2] -= N*fc
-        return freq
+        return self.ch2freq_fast(ch)
+
+    def ch2freq_fast(self, ch):
+        """
+        Same as ch2freq(), without input checks: ch must be an int or numpy array
+        of ints within [0,N). Looks up the channel-center table.
+        """
+        return self.ch_freqs[ch]
 
     def qout(self, value):
         self.qout_reg = value
@@ -3,7 +3,11 @@ from qick.qick import *
 from drivers.pfb import *
 from drivers.dds import *
 from drivers.misc import *
+from reducers import *
+from store import *
+from phase import *
 import numpy as np
+import concurrent.futures
 
 from tqdm.notebook import trange, tqdm
 
@@ -338,10 +342,10 @@ class AnalysisChain():
               
         if (fmix-fs/2) < f < (fmix+fs/2):
             f_ = f - fmix
-            k = pfb_b.freq2ch(f_)
+            k = pfb_b.freq2ch_fast(f_)
             
             # Compute resulting dds frequency.
-            fdds = f_ - pfb_b.ch2freq(k)
+            fdds = f_ - pfb_b.ch2freq_fast(k)
             
             # Program dds frequency.
             if self.dict['chain']['subtype'] == 'single':
@@ -389,7 +393,19 @@ class AnalysisChain():
             
             return streamer_b.get_data_all(verbose=verbose)
 
-        
+    async def get_data_all_async(self, verbose=False):
+        """
+        Same as get_data_all(), awaiting the DMA so other coroutines can run meanwhile.
+        """
+        streamer_b = getattr(self.soc, self.dict['chain']['streamer'])
+
+        # Check if any channel is enabled.
+        if self.anyenabled():
+            if verbose:
+                print("{}: Some channels are enabled. Retrieving data...".format(__class__.__name__))
+
+            return await streamer_b.get_data_all_async(verbose=verbose)
+
     def freq2ch(self, f):
         """
         Convert from frequency to PFB channel number after subtracting mixer frequency
@@ -634,10 +650,10 @@ class SynthesisChain():
             if self.dict['type'] == 'pfb':
                 pfb_b = getattr(self.soc, self.dict['chain']['pfb'])
                 dds_b = getattr(self.soc, self.dict['chain']['dds'])
-                k = pfb_b.freq2ch(f_)
+                k = pfb_b.freq2ch_fast(f_)
             
                 # Compute resulting dds frequency.
-                fdds = f_ - pfb_b.ch2freq(k)
+                fdds = f_ - pfb_b.ch2freq_fast(k)
 
                 # Do I need to disable previous channel?
                 if self.enabled_ch is not None:
@@ -923,7 +939,7 @@ class KidsChain():
         self.chs = pfb_b.freq2ch(self.qFreqs-fmix)
         if len(np.unique(self.chs)) != len(self.chs):
             raise ValueError("Tones are not in unique channels: %s"%(self.chs))
-        self.fOffsets = self.qFreqs - fmix - pfb_b.ch2freq(self.chs)
+        self.fOffsets = self.qFreqs - fmix - pfb_b.ch2freq_fast(self.chs)
         #check that chsel.ch2tran returns a 3-tuple on the ZCU216
         self.ntrans, _, _ = chsel.ch2tran(self.chs)
         self.idxs = chsel.ch2idx(self.chs)
@@ -936,11 +952,10 @@ class KidsChain():
         comp = cgs is not None
         if not comp:
             cgs = np.zeros(len(freqs))
-        dds_b.alloff()
-        
-        for fOffset,fiDeg,g,cg,ch in zip(self.fOffsets, fiDegs, gs, cgs, self.chs):
-            if verbose: print("mkids.py set_tones:  fOffset, fiDeg, g, cg, ch, comp=",fOffset, fiDeg, g, cg, ch, comp)
-            dds_b.ddscfg(f=fOffset*1e6, fi=fiDeg, g=g, cg=cg, ch=ch, comp=comp, verbose=verbose)
+        if verbose: print("mkids.py set_tones:  fOffsets, fiDegs, gs, cgs, chs, comp=",self.fOffsets, fiDegs, gs, cgs, self.chs, comp)
+
+        # Only channels that changed are written; unused channels are switched off.
+        dds_b.ddscfg_update(self.fOffsets*1e6, fiDegs, gs, cgs, self.chs, comp=comp, verbose=verbose)
         # Enable these tones for readout
         self.enable_channels(verbose)
 
@@ -964,16 +979,14 @@ class KidsChain():
         if len(self.enabledChs) == len(chs) and (self.enabledChs==chs).all():
             if verbose: print("mkids.py:  enabledChs and chs identical")
         else:
-            if verbose: print("mkids.py:  set enabledChs and call chsel.alloff and chsel.set")
+            if verbose: print("mkids.py:  set enabledChs and call chsel.apply_mask")
             self.enabledChs = np.array(self.chs)
             self.enabledChs.sort()
             chsel = getattr(self.soc, self.analysis.dict['chain']['chsel'])
-            chsel.alloff()
             if verbose:
                 print("mkids.py enable_channels:  self.chs=",self.chs)
-            for ch in self.chs:
-                if verbose: print("mkids.py enable_channels: ch =",ch)
-                chsel.set(ch, single=False, verbose=verbose)
+            # Only mask words that change are written.
+            chsel.apply_mask(self.chs, verbose=verbose)
                 
                 
     def get_sweep_offsets(self, bandwidth, nf):
@@ -999,7 +1012,7 @@ class KidsChain():
         return fOffsets
 
 
-    def sweep_tones(self, bandwidth, nf, doProgress=True, verbose=False, mean=True, nPreTruncate=100, nRepeats=1):
+    def sweep_tones(self, bandwidth, nf, doProgress=True, verbose=False, mean=True, nPreTruncate=100, nRepeats=1, plan=None, store=None, name='xs'):
         """
         Perform a frequency sweep of the tones set by set_tones()
         
@@ -1016,31 +1029,49 @@ class KidsChain():
                 calculates the mean value of all samples
             verbose:  boolean (default=False)
                 talk to me!
+            plan: SweepPlan (default=None)
+                precomputed sweep plan to replay.  If None, one is made from
+                the current tones, bandwidth and nf.
+            store: DataStore (default=None)
+                if given, each step is appended to the dataset name of the store
+                instead of being kept in memory, and the sweep settings are saved
+                in the store metadata
+            name: str (default='xs')
+                dataset name in store
             
         Returns:
         --------
-            xs : ndarray of complex doubles
+            xs : ndarray of complex doubles, or the store if one is given
                 first index:  frequency offset value
                 second index: tone number
                 third index (if mean=False): sample number
+
+        Sets:
+        -----
+            self.sweepPlan: the SweepPlan used, which can be saved and re-used
                 
         """
 
-        self.scanFOffsets = self.get_sweep_offsets(bandwidth, nf)
-        freqs = self.qFreqs    
+        if plan is None:
+            plan = SweepPlan(self, bandwidth, nf)
+        else:
+            plan.check(self, bandwidth, nf)
+        self.sweepPlan = plan
+        self.scanFOffsets = plan.dict['scanFOffsets']
+        nf = plan.nf
         if doProgress:
             iValues = trange(nf)
         else:
             iValues = range(nf)
         xs = []
         if verbose:
-            print("sweep_tones:  freqs=",freqs)
+            print("sweep_tones:  freqs=",plan.dict['qFreqs'])
             print("sweep_tones: self.scanFOffsets=",self.scanFOffsets)
         for i in iValues:
             if verbose:
                 print("sweep_tones:  i=%d"%i)
-                print("sweep_tones: freqs+self.scanFOffsets[i] =",freqs+self.scanFOffsets[i])
-            self.set_tones(freqs+self.scanFOffsets[i], self.fis, self.gs)
+                print("sweep_tones: freqs+self.scanFOffsets[i] =",plan.dict['qFreqs']+self.scanFOffsets[i])
+            self.apply_sweep_step(plan, i)
             self.enable_channels(verbose)
             thisXs = None
             for iRepeat in range(nRepeats):
@@ -1050,12 +1081,236 @@ class KidsChain():
                     thisXs = thisRead
                 else:
                     thisXs += thisRead
-            xs.append(thisXs/nRepeats)
+            if store is None:
+                xs.append(thisXs/nRepeats)
+            else:
+                if i == 0:
+                    store.set_meta(fMixer=self.synthesis.get_mixer_frequency(), qFreqs=plan.dict['qFreqs'],
+                                   fis=plan.dict['fis'], gs=plan.dict['gs'], scanFOffsets=self.scanFOffsets,
+                                   bandwidth=plan.dict['bandwidth'], nRepeats=nRepeats, nPreTruncate=nPreTruncate)
+                    store.create(name, thisXs.shape, thisXs.dtype, chunkRows=nf)
+                store.append(name, thisXs/nRepeats)
+        if store is not None:
+            return store
         return np.array(xs)
 
+    def record_xs(self, store, nReads, nPreTruncate=0, name='timestream', chunkRows=None):
+        """
+        Stream the x values of the current tones into a DataStore, as get_xs(mean=False) would
+        return them, without keeping them in memory.  Rows are samples, columns are tones.
+        Samples that not every tone has in a buffer are dropped, so all tones stay aligned.
+
+        Parameters:
+        -----------
+            store: DataStore
+                destination
+            nReads: int
+                number of DMA buffers to record
+            nPreTruncate: int (default 0)
+                number of samples to ignore at the beginning of each buffer
+            name: str (default='timestream')
+                dataset name
+            chunkRows: int (default None)
+                number of samples per file, None for files of about DataStore.CHUNK_BYTES
+
+        Returns:
+        --------
+            store: the DataStore
+        """
+        store.set_meta(fMixer=self.synthesis.get_mixer_frequency(), qFreqs=self.qFreqs,
+                       fis=self.fis, gs=self.gs, nPreTruncate=nPreTruncate)
+        store.create(name, (len(self.ntrans),), np.complex64, chunkRows=chunkRows)
+        for xs in self.iter_xs(nReads, nPreTruncate):
+            store.append(name, xs)
+        return store
+
+    def iter_xs(self, nReads=None, nPreTruncate=0):
+        """
+        Generator of the x values of the current tones, one DMA buffer at a time.
+        Samples that not every tone has in a buffer are dropped, so all tones stay aligned.
+
+        Parameters:
+        -----------
+            nReads: int (default None)
+                number of DMA buffers, None to stream until the generator is closed
+            nPreTruncate: int (default 0)
+                number of samples to ignore at the beginning of each buffer
+
+        Yields:
+        -------
+            xs: (nsamp, ntones) ndarray of complex64
+                rows are samples, columns are tones
+        """
+        streamer_b = getattr(self.soc, self.analysis.dict['chain']['streamer'])
+        for packets in streamer_b.stream(nt=nReads):
+            samples = ToneSamples(packets[:,:streamer_b.NS], packets[:,streamer_b.NS], self.ntrans, self.idxs, nPreTruncate)
+            yield samples.gather(samples.count.min()).T.astype(np.complex64)
+
+    async def sweep_tones_async(self, bandwidth, nf, verbose=False, mean=True, nPreTruncate=100, nRepeats=1, plan=None):
+        """
+        Same as sweep_tones(), as a coroutine.
+
+        Each DMA is started, the buffer of the previous read is decoded while the DMA runs,
+        and the DMA is then awaited, so other coroutines run while the hardware acquires.
+        Two DMA buffers are used in rotation.  Tones of the next step cannot be programmed
+        before the current read is complete, as that would change the tones being read.
+
+        Returns:
+        --------
+            xs : ndarray of complex doubles
+                first index:  frequency offset value
+                second index: tone number
+                third index (if mean=False): sample number
+        """
+        if plan is None:
+            plan = SweepPlan(self, bandwidth, nf)
+        else:
+            plan.check(self, bandwidth, nf)
+        self.sweepPlan = plan
+        self.scanFOffsets = plan.dict['scanFOffsets']
+        nf = plan.nf
+
+        streamer_b = getattr(self.soc, self.analysis.dict['chain']['streamer'])
+        buffs = streamer_b.stream_buffers(2)
+
+        xs = [None]*nf
+        def decode(step, buff):
+            thisRead = self.decode_sweep_read(plan, step, buff, mean, nPreTruncate)
+            if xs[step] is None:
+                xs[step] = thisRead
+            else:
+                xs[step] += thisRead
+
+        # (step, buffer) of the read waiting to be decoded.
+        previous = None
+        n = 0
+        for i in range(nf):
+            if verbose:
+                print("sweep_tones_async:  i=%d"%i)
+            self.apply_sweep_step(plan, i)
+            self.enable_channels(verbose)
+            for iRepeat in range(nRepeats):
+                buff = streamer_b.transfer_start(buffs[n % 2])
+                n += 1
+                if previous is not None:
+                    decode(*previous)
+                await streamer_b.transfer_wait_async()
+                previous = (i, buff)
+        decode(*previous)
+
+        return np.array(xs)/nRepeats
+
+    def sweep_tones_pipelined(self, bandwidth, nf, doProgress=True, verbose=False, mean=True, nPreTruncate=100, nRepeats=1, plan=None, nBuffers=3):
+        """
+        Same as sweep_tones(), with decoding moved to a worker thread.
+
+        Pipeline: while the worker decodes and reduces read k-1 (NumPy releases the GIL),
+        the main thread programs the tones of step k and waits for its DMA.  The time per
+        step is the largest of the two instead of their sum.  DMA buffers are rotated, and
+        a buffer is only re-used once its decode is finished.
+
+        Parameters:
+        -----------
+            nBuffers: int (default=3)
+                number of DMA buffers in rotation (at least 2)
+
+        Returns:
+        --------
+            xs : ndarray of complex doubles
+                first index:  frequency offset value
+                second index: tone number
+                third index (if mean=False): sample number
+        """
+        if plan is None:
+            plan = SweepPlan(self, bandwidth, nf)
+        else:
+            plan.check(self, bandwidth, nf)
+        self.sweepPlan = plan
+        self.scanFOffsets = plan.dict['scanFOffsets']
+        nf = plan.nf
+        if doProgress:
+            iValues = trange(nf)
+        else:
+            iValues = range(nf)
+
+        # Sanity check.
+        if nBuffers < 2:
+            raise ValueError("sweep_tones_pipelined needs at least 2 buffers, not %d" % nBuffers)
+
+        streamer_b = getattr(self.soc, self.analysis.dict['chain']['streamer'])
+        buffs = streamer_b.stream_buffers(nBuffers)
+
+        # Decode of each read, in order.
+        futures = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            for i in iValues:
+                if verbose:
+                    print("sweep_tones_pipelined:  i=%d"%i)
+                self.apply_sweep_step(plan, i)
+                self.enable_channels(verbose)
+                for iRepeat in range(nRepeats):
+                    n = len(futures)
+
+                    # Buffer must be decoded before it is re-used.
+                    if n >= nBuffers:
+                        futures[n-nBuffers].result()
+                    buff = buffs[n % nBuffers]
+                    streamer_b.transfer_start(buff)
+                    streamer_b.dma.recvchannel.wait()
+                    futures.append(executor.submit(self.decode_sweep_read, plan, i, buff, mean, nPreTruncate))
+
+            xs = [None]*nf
+            for n, future in enumerate(futures):
+                step = n//nRepeats
+                if xs[step] is None:
+                    xs[step] = future.result()
+                else:
+                    xs[step] += future.result()
+
+        return np.array(xs)/nRepeats
+
+    def decode_sweep_read(self, plan, i, buff, mean=True, nPreTruncate=100):
+        """
+        Decode a DMA buffer read at step i of a SweepPlan.
+
+        Only the plan values of step i are used, so the tones of the next steps may already
+        be programmed.
+
+        Returns:
+        --------
+            xs : ndarray of complex doubles
+                first index: tone number
+                second index (if mean=False): sample number
+        """
+        streamer_b = getattr(self.soc, self.analysis.dict['chain']['streamer'])
+        if mean:
+            iq, idx = streamer_b.decode(buff)
+            reducer = MeanReducer()
+            reducer.add(ToneSamples(iq, idx, plan.dict['ntrans'][i], plan.dict['idxs'][i], nPreTruncate))
+            return reducer.result()['mean']
+        dataAll = streamer_b.format_data(buff)
+        return np.array(self.extract_xs(dataAll, mean, nPreTruncate, plan.dict['ntrans'][i], plan.dict['idxs'][i]))
+
 
     
     
+    def apply_sweep_step(self, plan, i):
+        """
+        Program the tones of step i of a SweepPlan, and set the same data values as set_tones()
+        """
+        dds_b = getattr(self.soc, self.synthesis.dict['chain']['dds'])
+
+        # Write the pre-quantized DDS words.
+        dds_b.update_words(plan.step_words(i))
+
+        # Values used for readout.
+        self.qFreqs   = plan.dict['qFreqs'] + plan.dict['scanFOffsets'][i]
+        self.chs      = plan.dict['chs'][i]
+        self.fOffsets = plan.dict['fOffsets'][i]
+        self.ntrans   = plan.dict['ntrans'][i]
+        self.idxs     = plan.dict['idxs'][i]
+        self.cgs      = None
+
     def source(self, source="product"):
         # Set source using analysis chain.
         self.analysis.source(source = source)
@@ -1088,12 +1343,90 @@ class KidsChain():
             xs : list of ndarrays
                 complex values indexed by tone number
         """
+        if mean:
+            # Means straight from the int16 buffer.
+            streamer_b = getattr(self.soc, self.analysis.dict['chain']['streamer'])
+            if verbose:
+                print("mkids.py:  get_xs with MeanReducer")
+            iq, idx = streamer_b.decode(streamer_b.transfer_raw())
+            reducer = MeanReducer()
+            reducer.add(ToneSamples(iq, idx, self.ntrans, self.idxs, nPreTruncate))
+            return list(reducer.result()['mean'])
+
         dataAll = self.analysis.get_data_all(verbose)
+        return self.extract_xs(dataAll, mean, nPreTruncate)
+
+    def reduce(self, reducers, nReads=1, nPreTruncate=0):
+        """
+        Acquire nReads buffers of the current tones and feed them to reducers (see reducers.py).
+        Buffers are streamed, so the next DMA runs while a buffer is reduced.
+
+        Parameters:
+        -----------
+            reducers: reducer or list of reducers
+                for example MeanReducer(), DecimateReducer(100), PsdReducer(1024, fs)
+            nReads: int (default 1)
+                number of DMA buffers
+            nPreTruncate: int (default 0)
+                number of samples of each tone to ignore at the beginning of each buffer
+
+        Returns:
+        --------
+            result : dict or list of dict
+                result() of each reducer
+        """
+        single = not isinstance(reducers, (list, tuple))
+        if single:
+            reducers = [reducers]
+
+        streamer_b = getattr(self.soc, self.analysis.dict['chain']['streamer'])
+        for packets in streamer_b.stream(nt=nReads):
+            samples = ToneSamples(packets[:,:streamer_b.NS], packets[:,streamer_b.NS], self.ntrans, self.idxs, nPreTruncate)
+            for reducer in reducers:
+                reducer.add(samples)
+
+        results = [reducer.result() for reducer in reducers]
+        if single:
+            return results[0]
+        return results
+
+    async def get_xs_async(self, mean=False, verbose=False, nPreTruncate=0):
+        """
+        Same as get_xs(), awaiting the DMA so other coroutines can run meanwhile.
+        """
+        if mean:
+            streamer_b = getattr(self.soc, self.analysis.dict['chain']['streamer'])
+            iq, idx = streamer_b.decode(await streamer_b.transfer_async())
+            reducer = MeanReducer()
+            reducer.add(ToneSamples(iq, idx, self.ntrans, self.idxs, nPreTruncate))
+            return list(reducer.result()['mean'])
+
+        dataAll = await self.analysis.get_data_all_async(verbose)
+        return self.extract_xs(dataAll, mean, nPreTruncate)
+
+    def extract_xs(self, dataAll, mean=False, nPreTruncate=0, ntrans=None, idxs=None):
+        """
+        Extract the (complex) x values of all tones from data formatted by AxisStreamerV1.format_data()
+
+        Parameters:
+        -----------
+            ntrans, idxs: ndarray of ints (default None)
+                transaction and lane of each tone, if not those of the current tones
+                (self.ntrans, self.idxs)
+
+        Returns:
+        --------
+            xs : list of ndarrays
+                complex values indexed by tone number
+        """
+        if ntrans is None:
+            ntrans = self.ntrans
+            idxs = self.idxs
         xs = []
         samples = dataAll['samples']
-        for iTone in range(len(self.qFreqs)):
-            ntran = self.ntrans[iTone]
-            idx = self.idxs[iTone]
+        for iTone in range(len(ntrans)):
+            ntran = ntrans[iTone]
+            idx = idxs[iTone]
             si = samples[ntran]
             xs.append(si[2*idx][nPreTruncate:] + 1j*si[2*idx+1][nPreTruncate:])
             if mean:
@@ -1203,20 +1536,55 @@ class KidsChain():
         phi_dt = phi_dt - phi_dt[0]
 
         # Phase-jump correction.
-        k = np.zeros(len(f))
-        for i in range(len(f)):
-            k[i] = self.synthesis.freq2ch(f[i])
+        k = self.synthesis.freq2ch(f)
 
         # Apply jump compensation.
         phi_dt = phi_dt - phase_cal*(k - k[0])
 
         return phi_u, phi_dt
 
+    def segment_fits(self, f, phi, starts, ends):
+        """
+        Straight-line least-squares fits of phi versus f on the segments [starts[i], ends[i]),
+        all solved at once.
+
+        Returns:
+        --------
+            slopes, intercepts : ndarray of double
+                one value per segment
+            x, y, fn : list of ndarray
+                data and fitted values of each segment
+        """
+        lengths = ends - starts
+        if np.any(lengths < 2):
+            raise ValueError("Segments need at least 2 points: %s" % lengths)
+
+        # Segment number and data index of every point used.
+        seg = np.repeat(np.arange(len(starts)), lengths)
+        offsets = np.cumsum(lengths) - lengths
+        idx = np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(starts, lengths)
+        x = f[idx]
+        y = phi[idx]
+
+        # Centered sums.
+        mx = np.bincount(seg, weights=x)/lengths
+        my = np.bincount(seg, weights=y)/lengths
+        dx = x - mx[seg]
+        slopes = np.bincount(seg, weights=dx*(y - my[seg]))/np.bincount(seg, weights=dx*dx)
+        intercepts = my - slopes*mx
+        fn = slopes[seg]*x + intercepts[seg]
+
+        split = np.cumsum(lengths)[:-1]
+        return slopes, intercepts, np.split(x, split), np.split(y, split), np.split(fn, split)
+
     def phase_fit(self, f, phi, jumps=True, gap=5):
         # Dictionary for output data.
         data = {}
         data['fits'] = []
-        
+
+        f = np.asarray(f)
+        phi = np.asarray(phi)
+
         # Delay estimation using phase jumps.
         if jumps:
             # Phase diff.
@@ -1226,53 +1594,150 @@ class KidsChain():
             jv = 0.8*np.max(np.abs(phi_diff))                
             idx = np.argwhere(np.abs(phi_diff) > jv).reshape(-1)
             data['jump'] = {'threshold' : jv, 'index' : idx, 'value' : phi_diff[idx]}
-            
-            idx_start = 0
-            idx_end = len(f)
-            for i in range(len(idx)):
-                idx_end = idx[i]
-                
-                # Move away from midpoint.
-                idx_start = idx_start + gap
-                idx_end = idx_end - gap
-                
-                x = f[idx_start:idx_end]
-                y = phi[idx_start:idx_end]
-                coef = np.polyfit(x,y,1)
-                fit_fn = np.poly1d(coef)
-                
-                fit_ = {'slope' : coef[0], 'data' : {'x' : x, 'y': y, 'fn' : fit_fn(x)}}
-                data['fits'].append(fit_)
-                
-                # Update start index.
-                idx_start = idx_end + gap
-                
-            # Section after last jump.
-            idx_end = len(f)
-    
-            # Move away from midpoint.
-            idx_start = idx_start + gap
-            idx_end = idx_end - gap
-    
-            x = f[idx_start:idx_end]
-            y = phi[idx_start:idx_end]
-            coef = np.polyfit(x,y,1)
-            fit_fn = np.poly1d(coef)
-    
-            fit_ = {'slope' : coef[0], 'data' : {'x' : x, 'y': y, 'fn' : fit_fn(x)}}
-            data['fits'].append(fit_)        
-            
-            return data
-        
+
+            # Sections between jumps, moved away from the jumps by gap points.
+            starts = np.concatenate(([0], idx)) + gap
+            ends = np.concatenate((idx, [len(f)])) - gap
+
         # Overall delay estimation.
         else:
-            coef   = np.polyfit(f,phi, 1)
-            fit_fn = np.poly1d(coef)
-            
-            fit_ = {'slope' : coef[0], 'data' : {'x' : f, 'y' : phi, 'fn' : fit_fn(f)}}
+            starts = np.array([0])
+            ends = np.array([len(f)])
+
+        slopes, _, xs, ys, fns = self.segment_fits(f, phi, starts, ends)
+        for slope, x, y, fn in zip(slopes, xs, ys, fns):
+            fit_ = {'slope' : slope, 'data' : {'x' : x, 'y' : y, 'fn' : fn}}
             data['fits'].append(fit_)
-            
-            return data
+
+        return data
+
+class SweepPlan():
+    """
+    Precomputed settings of every step of a KidsChain.sweep_tones() sweep.
+
+    All frequencies are quantized, mapped to channels, transactions and lane indices,
+    and converted into DDS register words once.  The sweep then only replays the plan.
+    Plans can be saved to disk and re-used for the same sweep: same mixer frequency,
+    frequency resolution and DDS output selection, same tones (set again with set_tones()
+    before the sweep), and same bandwidth and number of frequencies.
+    """
+    # Arrays stored by save().
+    KEYS = ['fmix', 'fr', 'bandwidth', 'qFreqs', 'fis', 'gs', 'scanFOffsets',
+            'chs', 'fOffsets', 'ntrans', 'idxs', 'pinc', 'phase', 'gain', 'cgain', 'cfg']
+
+    # Constructor.
+    def __init__(self, kids=None, bandwidth=None, nf=None, **arrays):
+        """
+        Make a plan for the tones set by kids.set_tones(), or re-create one from saved arrays.
+
+        Parameters:
+        -----------
+            kids: KidsChain
+                chain with tones already set with set_tones()
+            bandwidth: double
+                nominal width of frequency scan
+            nf: int
+                number of frequency values
+            arrays:
+                values stored by save(), used by load()
+        """
+        self.dict = {}
+        if kids is None:
+            self.dict.update(arrays)
+            self.dict['bandwidth'] = bandwidth
+        else:
+            self.make(kids, bandwidth, nf)
+
+    def make(self, kids, bandwidth, nf):
+        pfb_b = getattr(kids.soc, kids.synthesis.dict['chain']['pfb'])
+        dds_b = getattr(kids.soc, kids.synthesis.dict['chain']['dds'])
+        chsel = getattr(kids.soc, kids.analysis.dict['chain']['chsel'])
+        fmix  = kids.synthesis.dict['mixer']['freq']
+
+        scanFOffsets = kids.get_sweep_offsets(bandwidth, nf)
+
+        # First index: step, second index: tone.
+        qFreqs = kids.fq(kids.qFreqs[np.newaxis,:] + scanFOffsets[:,np.newaxis])
+        chs = pfb_b.freq2ch(qFreqs-fmix)
+        chsSorted = np.sort(chs, axis=1)
+        if np.any(chsSorted[:,1:] == chsSorted[:,:-1]):
+            i = np.argwhere(chsSorted[:,1:] == chsSorted[:,:-1])[0,0]
+            raise ValueError("Tones are not in unique channels at step %d: %s"%(i, chs[i]))
+        fOffsets = qFreqs - fmix - pfb_b.ch2freq_fast(chs)
+        ntrans, _, _ = chsel.ch2tran(chs)
+        idxs = chsel.ch2idx(chs)
+
+        # DDS words. All values but the phase increment are the same for every step.
+        # Sweep steps are programmed without compensation, as set_tones(freqs, fis, gs) does.
+        words = dds_b.ddscfg_words(fOffsets*1e6, np.degrees(kids.fis), kids.gs, None, chs)
+
+        self.dict['fmix']         = fmix
+        self.dict['fr']           = kids.fr
+        self.dict['bandwidth']    = bandwidth
+        self.dict['qFreqs']       = np.array(kids.qFreqs)
+        self.dict['fis']          = np.array(kids.fis)
+        self.dict['gs']           = np.array(kids.gs)
+        self.dict['scanFOffsets'] = scanFOffsets
+        self.dict['chs']          = chs.astype(np.int32)
+        self.dict['fOffsets']     = fOffsets
+        self.dict['ntrans']       = np.asarray(ntrans).astype(np.int32)
+        self.dict['idxs']         = np.asarray(idxs).astype(np.int32)
+        self.dict['pinc']         = words['pinc']
+        for k in ['phase', 'gain', 'cgain', 'cfg']:
+            self.dict[k] = words[k][0]
+
+    @property
+    def nf(self):
+        return len(self.dict['scanFOffsets'])
+
+    def step_words(self, i):
+        """
+        Return the DDS words of step i, as returned by AxisDdsDualV1.ddscfg_words()
+        """
+        words = {'ch' : self.dict['chs'][i].astype(np.int64), 'pinc' : self.dict['pinc'][i]}
+        for k in ['phase', 'gain', 'cgain', 'cfg']:
+            words[k] = self.dict[k]
+        return words
+
+    def check(self, kids, bandwidth=None, nf=None):
+        """
+        Raise ValueError if the plan cannot be replayed on the KidsChain kids, for the tones
+        set with set_tones() and a sweep of nf frequencies over bandwidth (None to not check them).
+        """
+        fmix = kids.synthesis.dict['mixer']['freq']
+        if fmix != self.dict['fmix']:
+            raise ValueError("SweepPlan made for mixer frequency %f MHz, but mixer is set to %f MHz"%(self.dict['fmix'], fmix))
+        if kids.fr != self.dict['fr']:
+            raise ValueError("SweepPlan made for frequency resolution %g MHz, but chain has %g MHz"%(self.dict['fr'], kids.fr))
+        for k in ['qFreqs', 'fis', 'gs']:
+            if not np.array_equal(getattr(kids, k), self.dict[k]):
+                raise ValueError("SweepPlan made for %s=%s, but tones have %s=%s"%(k, self.dict[k], k, getattr(kids, k)))
+        # The DDS output selection is part of the cfg word.
+        dds_b = getattr(kids.soc, kids.synthesis.dict['chain']['dds'])
+        cfg = dds_b.ddscfg_words(0, 0, 0, None, 0)['cfg'][0]
+        if cfg != self.dict['cfg']:
+            raise ValueError("SweepPlan made for DDS cfg word %d, but DDS gives %d (sel_default=%s)"%(self.dict['cfg'], cfg, dds_b.sel_default))
+        if bandwidth is not None and bandwidth != self.dict['bandwidth']:
+            raise ValueError("SweepPlan made for bandwidth %f MHz, not %f MHz"%(self.dict['bandwidth'], bandwidth))
+        if nf is not None and nf != self.nf:
+            raise ValueError("SweepPlan made for nf=%d, not %d"%(self.nf, nf))
+
+    def save(self, filename):
+        """
+        Save the plan into a .npz file
+        """
+        np.savez(filename, **{k : self.dict[k] for k in self.KEYS})
+
+    @classmethod
+    def load(cls, filename):
+        """
+        Load a plan saved with save()
+        """
+        with np.load(filename) as f:
+            arrays = {k : f[k] for k in cls.KEYS}
+        for k in ['fmix', 'fr', 'bandwidth']:
+            arrays[k] = float(arrays[k])
+        return cls(**arrays)
 
 class SimuChain():
     # Constructor.
@@ -2024,10 +2489,25 @@ def measureDelay(offsets, xs, plotFit=False):
         plt.title("delay=%f  amplitude=%f"%(delay,amplitude0))
     return delay,phi0
 
-def applyDelay(fTones, offsets, xs, delay):
-    retval = np.array(xs)
-    for iTone,fTone in enumerate(fTones): 
-        a = np.abs(retval[:,iTone])
-        phi = np.angle(retval[:,iTone])
-        retval[:,iTone] = a*np.exp(1j*(phi-2*np.pi*((delay*(fTone+offsets)))))
-    return retval
+def applyDelay(fTones, offsets, xs, delay, out=None):
+    """
+    Remove the phase of a delay from a sweep: xs[i,j] is rotated by -2*pi*delay*(fTones[j]+offsets[i]).
+
+    Parameters:
+    -----------
+        fTones : ndarray
+            frequency of each tone (MHz)
+        offsets : ndarray
+            frequency offsets of the sweep (MHz)
+        xs : ndarray of complex
+            sweep, first index offset, second index tone (and third index sample, if any)
+        delay : float
+            delay (us)
+        out : ndarray
+            None (default) to return a new array, xs to apply the delay in place
+
+    Returns:
+    --------
+        xs with the delay removed
+    """
+    return applyPhasors(xs, delayPhasors(fTones, offsets, delay), out=out)
@@ -0,0 +1,96 @@
+"""
+Phase rotations as complex multiplies.
+
+Rotating x by phi as np.abs(x)*np.exp(1j*(np.angle(x)+phi)) makes three transcendental
+passes over x, and allocates as many temporaries. Multiplying x by the phasor exp(1j*phi)
+gives the same result with one multiply, which can be done in place. Phasors usually depend
+only on the tone, or on the (offset, tone) of a sweep, so they are computed once for all
+samples; the phasors of a delay are cached, since the same sweep is often repeated.
+
+    xs = kids.sweep_tones(bandwidth, nf)
+    applyPhasors(xs, delayPhasors(freqs, kids.scanFOffsets, delay), out=xs)
+"""
+import threading
+from collections import OrderedDict
+import numpy as np
+
+def phasors(phis):
+    """
+    exp(1j*phis), computed as cos + 1j*sin without a complex temporary.
+    """
+    phis = np.asarray(phis, dtype=float)
+    retval = np.empty(phis.shape, dtype=complex)
+    np.cos(phis, out=retval.real)
+    np.sin(phis, out=retval.imag)
+    return retval
+
+def applyPhasors(xs, p, axis=0, out=None):
+    """
+    Multiply xs by the phasors p.
+
+    Parameters:
+    -----------
+        xs : ndarray of complex
+            values to rotate
+        p : ndarray of complex
+            phasors, for the axes of xs starting at axis; they are broadcast over the following axes
+            (for example the samples of a sweep with mean=False)
+        axis : int
+            axis of xs matching the first axis of p
+        out : ndarray
+            where to write the result: None (default) for a new array, xs to rotate in place
+
+    Returns:
+    --------
+        rotated : ndarray of complex
+    """
+    xs = np.asarray(xs)
+    p = np.asarray(p)
+    p = p.reshape(p.shape + (1,)*(xs.ndim - axis - p.ndim))
+    return np.multiply(xs, p, out=out)
+
+def rotatePhase(xs, phis, axis=0, out=None):
+    """
+    Add phis (in radians) to the phase of xs; see applyPhasors.
+    """
+    return applyPhasors(xs, phasors(phis), axis=axis, out=out)
+
+DELAY_CACHE_SIZE = 16
+_delayCache = OrderedDict()
+_delayCacheLock = threading.Lock()
+
+def delayPhasors(fTones, offsets, delay):
+    """
+    Phasors that remove a delay from a sweep: exp(-2j*pi*delay*(offsets[i] + fTones[j])).
+
+    exp(a+b) = exp(a)*exp(b), so these are the outer product of nf and ntones phasors,
+    instead of nf*ntones complex exponentials. The result is read-only and cached.
+
+    Parameters:
+    -----------
+        fTones : ndarray
+            frequency of each tone (MHz)
+        offsets : ndarray
+            frequency offsets of the sweep (MHz)
+        delay : float
+            delay (us)
+
+    Returns:
+    --------
+        p : (len(offsets), len(fTones)) ndarray of complex
+    """
+    fTones = np.ascontiguousarray(fTones, dtype=float)
+    offsets = np.ascontiguousarray(offsets, dtype=float)
+    key = (float(delay), fTones.shape, fTones.tobytes(), offsets.shape, offsets.tobytes())
+    with _delayCacheLock:
+        if key in _delayCache:
+            _delayCache.move_to_end(key)
+            return _delayCache[key]
+
+    p = np.multiply.outer(phasors(-2*np.pi*delay*offsets), phasors(-2*np.pi*delay*fTones))
+    p.setflags(write=False)
+    with _delayCacheLock:
+        _delayCache[key] = p
+        if len(_delayCache) > DELAY_CACHE_SIZE:
+            _delayCache.popitem(last=False)
+    return p
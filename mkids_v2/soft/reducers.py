@@ -0,0 +1,215 @@
+"""
+Streaming reducers: per-tone statistics computed straight from the int16 samples of
+AxisStreamerV1 DMA buffers, without building a complex array of samples for every tone.
+
+The samples of one buffer are grouped once (ToneSamples) and then fed to any number of
+reducers, which accumulate over as many buffers as needed:
+
+    mean = MeanReducer()
+    psd  = PsdReducer(nperseg=1024, fs=fs)
+    for packets in streamer.stream(nt=100):
+        samples = ToneSamples(packets[:,:streamer.NS], packets[:,streamer.NS], kids.ntrans, kids.idxs)
+        mean.add(samples)
+        psd.add(samples)
+    mean.result()['mean'], psd.result()['psd']
+
+KidsChain.reduce() does this loop.
+"""
+import numpy as np
+from scipy.signal import get_window
+
+class ToneSamples():
+    """
+    Samples of each tone in a buffer, located with a single stable sort of the transaction index.
+    Samples are read from the buffer when needed: feed the reducers before the buffer is re-used.
+    """
+    def __init__(self, iq, idx, ntrans, idxs, nPreTruncate=0):
+        """
+        Parameters:
+        -----------
+            iq, idx : ndarray of int16
+                (nsamp, NS) I/Q samples and (nsamp,) transaction index, as returned by
+                AxisStreamerV1.decode()
+            ntrans, idxs : ndarray of ints
+                transaction and lane of each tone
+            nPreTruncate : int
+                number of samples of each tone to ignore at the beginning of the buffer
+        """
+        self.iq = iq
+        self.idx = idx
+        self.ntrans = np.asarray(ntrans).astype(np.intp)
+        self.nPreTruncate = nPreTruncate
+        idxs = np.asarray(idxs).astype(np.intp)
+
+        # Stable sort of the (int16) index: samples of each transaction, in time order.
+        self.order = np.argsort(idx, kind='stable')
+        self.counts = np.bincount(idx, minlength=self.ntrans.max()+1)
+        self.starts = np.cumsum(self.counts) - self.counts
+
+        # Range [first, last) of the samples of each tone in the sorted samples.
+        self.last  = self.starts[self.ntrans] + self.counts[self.ntrans]
+        self.first = np.minimum(self.starts[self.ntrans] + nPreTruncate, self.last)
+        self.count = self.last - self.first
+
+        self.icol = 2*idxs
+        self.qcol = 2*idxs + 1
+
+    @property
+    def ntones(self):
+        return len(self.icol)
+
+    def sums(self):
+        """
+        Sums of I, Q and I^2+Q^2 of each tone, exact integers held in float64.
+        Computed per transaction and lane with bincount, without sorting the samples.
+        """
+        iq = self.iq
+        idx = self.idx
+        if self.nPreTruncate > 0:
+            # Rank of each sample within its transaction.
+            rank = np.empty(len(idx), dtype=np.intp)
+            rank[self.order] = np.arange(len(idx)) - np.repeat(self.starts, self.counts)
+            keep = rank >= self.nPreTruncate
+            iq = iq[keep]
+            idx = idx[keep]
+
+        # Sums per lane (column) and transaction, for the lanes in use.
+        s1 = np.zeros((iq.shape[1], len(self.counts)))
+        s2 = np.zeros((iq.shape[1], len(self.counts)))
+        for col in np.unique(np.concatenate((self.icol, self.qcol))):
+            x = iq[:,col].astype(np.float64)
+            s1[col] = np.bincount(idx, weights=x, minlength=len(self.counts))
+            s2[col] = np.bincount(idx, weights=x*x, minlength=len(self.counts))
+
+        sumI  = s1[self.icol, self.ntrans]
+        sumQ  = s1[self.qcol, self.ntrans]
+        sumSq = s2[self.icol, self.ntrans] + s2[self.qcol, self.ntrans]
+        return sumI, sumQ, sumSq
+
+    def lane(self, cols, n):
+        """
+        (ntones, n) int16 array with the first n samples of each tone, column cols[tone].
+        """
+        rows = self.order[self.first[:,np.newaxis] + np.arange(n)]
+        return self.iq[rows, cols[:,np.newaxis]]
+
+    def gather(self, n):
+        """
+        (ntones, n) complex array with the first n samples of each tone.
+        """
+        return self.lane(self.icol, n) + 1j*self.lane(self.qcol, n)
+
+class MeanReducer():
+    """
+    Mean and variance of each tone, from sums, sums of squares and counts.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.sumI  = 0
+        self.sumQ  = 0
+        self.sumSq = 0
+        self.count = 0
+
+    def add(self, samples):
+        sumI, sumQ, sumSq = samples.sums()
+        self.sumI  = self.sumI + sumI
+        self.sumQ  = self.sumQ + sumQ
+        self.sumSq = self.sumSq + sumSq
+        self.count = self.count + samples.count
+
+    def result(self):
+        """
+        Returns:
+        --------
+            result : dict
+                'mean'  : complex mean of each tone
+                'var'   : variance of each tone, mean of |x - mean|^2
+                'count' : number of samples of each tone
+        """
+        mean = (self.sumI + 1j*self.sumQ)/self.count
+        var = self.sumSq/self.count - np.abs(mean)**2
+        return {'mean' : mean, 'var' : var, 'count' : self.count}
+
+class DecimateReducer():
+    """
+    Time stream of each tone, averaged over blocks of factor samples.
+    Samples of a buffer that do not fill a block (for every tone) are dropped.
+    """
+    def __init__(self, factor):
+        self.factor = factor
+        self.reset()
+
+    def reset(self):
+        self.blocks = []
+
+    def add(self, samples):
+        nblocks = samples.count.min()//self.factor
+        if nblocks == 0:
+            return
+        n = nblocks*self.factor
+        shape = (samples.ntones, nblocks, self.factor)
+        sumI = samples.lane(samples.icol, n).reshape(shape).sum(axis=-1, dtype=np.int64)
+        sumQ = samples.lane(samples.qcol, n).reshape(shape).sum(axis=-1, dtype=np.int64)
+        self.blocks.append((sumI + 1j*sumQ)/self.factor)
+
+    def result(self):
+        """
+        Returns:
+        --------
+            result : dict
+                'xs' : (ntones, nblocks) complex block means
+        """
+        if len(self.blocks) == 0:
+            return {'xs' : np.zeros((0,0), dtype=complex)}
+        return {'xs' : np.concatenate(self.blocks, axis=1)}
+
+class PsdReducer():
+    """
+    Two-sided power spectral density of each tone, averaged over segments of nperseg samples
+    (Hann window, segment mean removed, as scipy.signal.welch with return_onesided=False and
+    no overlap). Samples of a buffer that do not fill a segment (for every tone) are dropped.
+    """
+    def __init__(self, nperseg=1024, fs=1.0):
+        self.nperseg = nperseg
+        self.fs = fs
+        self.window = get_window('hann', nperseg)
+        self.reset()
+
+    def reset(self):
+        self.psd = 0
+        self.nseg = 0
+
+    def add(self, samples):
+        nseg = samples.count.min()//self.nperseg
+        if nseg == 0:
+            return
+        x = samples.gather(nseg*self.nperseg).reshape((samples.ntones, nseg, self.nperseg))
+        x -= x.mean(axis=-1, keepdims=True)
+        x *= self.window
+        X = np.fft.fft(x, axis=-1)
+        self.psd = self.psd + (X.real**2 + X.imag**2).sum(axis=1)
+        self.nseg += nseg
+
+    def result(self):
+        """
+        Returns:
+        --------
+            result : dict
+                'f'    : frequencies, in units of fs, from -fs/2
+                'psd'  : (ntones, nperseg) PSD, in ADU^2/(unit of fs)
+                'nseg' : number of segments averaged
+
+        Raises:
+        -------
+            ValueError
+                if no buffer had nperseg samples of every tone
+        """
+        # Sanity check.
+        if self.nseg == 0:
+            raise ValueError("No segment of %d samples for every tone: use a smaller nperseg or longer buffers" % self.nperseg)
+        scale = 1/(self.fs*np.sum(self.window**2))
+        f = np.fft.fftshift(np.fft.fftfreq(self.nperseg, 1/self.fs))
+        psd = np.fft.fftshift(self.psd*scale/self.nseg, axes=-1)
+        return {'f' : f, 'psd' : psd, 'nseg' : self.nseg}
@@ -1,3 +1,5 @@
+import os
+import concurrent.futures
 import scipy.optimize
 import numpy as np
 """
@@ -77,20 +79,505 @@ def firstGuess(fl, iqs):
     c = -2
     return q,fc,a,v,c,theta,gi,gq,ic,qc
 
-def fitResonance(freqs, iqs):
+class MazinResonanceModel():
     """
-    fit the resonance.  
-    
+    mazinResonance and its analytic Jacobian for a fixed set of frequencies.
+
+    All intermediate values are kept in buffers allocated once, so the many evaluations made
+    by curve_fit do not allocate memory. evaluate() and jacobian() have the signatures
+    expected by curve_fit (f and jac); the x argument is ignored, the frequencies given
+    to the constructor are used. The returned arrays are overwritten by the next call.
+    """
+    def __init__(self, x):
+        self.x = np.array(x, dtype=float)
+        n = len(self.x)
+
+        # Real and complex work buffers.
+        self.dx = np.empty(n)
+        self.tr = np.empty(n)
+        self.z  = np.empty(n, dtype=complex)
+        self.f  = np.empty(n, dtype=complex)
+        self.ev = np.empty(n, dtype=complex)
+        self.w  = np.empty(n, dtype=complex)
+        self.tc = np.empty(n, dtype=complex)
+
+        # Outputs: [I, Q] values and (2n, 10) Jacobian.
+        self.out = np.empty(2*n)
+        self.jac = np.empty((2*n, 10))
+
+    def _core(self, q, f0, a, v, c):
+        # dx = (x-f0)/f0
+        dx = self.dx
+        np.subtract(self.x, f0, out=dx)
+        dx /= f0
+
+        # z = 2jq dx, w = 1+z, f = z/w - 0.5 + c dx + a(1-exp(jv dx))
+        np.multiply(dx, 2j*q, out=self.z)
+        np.add(self.z, 1, out=self.w)
+        np.divide(self.z, self.w, out=self.f)
+        self.f += a - 0.5
+        np.multiply(dx, c, out=self.tr)
+        self.f += self.tr
+        np.multiply(dx, 1j*v, out=self.ev)
+        np.exp(self.ev, out=self.ev)
+        np.multiply(self.ev, a, out=self.tc)
+        self.f -= self.tc
+
+    def _project(self, d, re, im, gi, gq, cs, sn):
+        # Columns of gi Re(d) + j gq Im(d), rotated by theta.
+        np.multiply(d.real, gi*cs, out=re)
+        np.multiply(d.imag, gq*sn, out=self.tr)
+        re -= self.tr
+        np.multiply(d.real, gi*sn, out=im)
+        np.multiply(d.imag, gq*cs, out=self.tr)
+        im += self.tr
+
+    def evaluate(self, x, q, f0, a, v, c, theta, gi, gq, ic, qc):
+        """
+        Same values as mazinResonance(self.x, ...).
+        """
+        n = len(self.x)
+        self._core(q, f0, a, v, c)
+        re = self.out[:n]
+        im = self.out[n:]
+        self._project(self.f, re, im, gi, gq, np.cos(theta), np.sin(theta))
+        re += ic
+        im += qc
+        return self.out
+
+    def jacobian(self, x, q, f0, a, v, c, theta, gi, gq, ic, qc):
+        """
+        Derivatives of evaluate() with respect to (q, f0, a, v, c, theta, gi, gq, ic, qc).
+        """
+        n = len(self.x)
+        cs = np.cos(theta)
+        sn = np.sin(theta)
+        self._core(q, f0, a, v, c)
+        jac = self.jac
+        d = self.tc
+
+        # 1/(1+z)^2.
+        np.multiply(self.w, self.w, out=self.w)
+        np.divide(1, self.w, out=self.w)
+
+        # q: 2j dx/(1+z)^2
+        np.multiply(self.w, self.dx, out=d)
+        d *= 2j
+        self._project(d, jac[:n,0], jac[n:,0], gi, gq, cs, sn)
+
+        # f0: (2jq/(1+z)^2 + c - jav exp(jv dx)) * (-x/f0^2)
+        np.multiply(self.w, 2j*q, out=d)
+        d += c
+        np.multiply(self.ev, 1j*a*v, out=self.z)
+        d -= self.z
+        d *= self.x
+        d *= -1/f0**2
+        self._project(d, jac[:n,1], jac[n:,1], gi, gq, cs, sn)
+
+        # a: 1-exp(jv dx)
+        np.subtract(1, self.ev, out=d)
+        self._project(d, jac[:n,2], jac[n:,2], gi, gq, cs, sn)
+
+        # v: -ja dx exp(jv dx)
+        np.multiply(self.ev, self.dx, out=d)
+        d *= -1j*a
+        self._project(d, jac[:n,3], jac[n:,3], gi, gq, cs, sn)
+
+        # c: dx (real)
+        np.multiply(self.dx, gi*cs, out=jac[:n,4])
+        np.multiply(self.dx, gi*sn, out=jac[n:,4])
+
+        # theta: j (f3 - ic - jqc)
+        self._project(self.f, jac[n:,5], jac[:n,5], gi, gq, cs, sn)
+        jac[:n,5] *= -1
+
+        # gi: Re(f) rotated, gq: j Im(f) rotated.
+        np.multiply(self.f.real, cs, out=jac[:n,6])
+        np.multiply(self.f.real, sn, out=jac[n:,6])
+        np.multiply(self.f.imag, -sn, out=jac[:n,7])
+        np.multiply(self.f.imag, cs, out=jac[n:,7])
+
+        # ic, qc.
+        jac[:n,8] = 1
+        jac[n:,8] = 0
+        jac[:n,9] = 0
+        jac[n:,9] = 1
+        return jac
+
+def fitResonance(freqs, iqs, jac=False):
+    """
+    fit the resonance.
+
     Returns the result of scipy.optimize.curve_fit
-    
+
     The parameters are the first element in the order used by mazinResonance.
-    
+
     So, for example, the fit frequency is rv[0][1]
+
+    With jac=True the fit uses MazinResonanceModel (analytic Jacobian, no finite differences).
     """
     p0 = firstGuess(freqs, iqs)
     iqsF = np.array([np.real(iqs), np.imag(iqs)]).reshape((-1))
-    rv = scipy.optimize.curve_fit(mazinResonance, freqs, iqsF, p0)
+    if jac:
+        model = MazinResonanceModel(freqs)
+        rv = scipy.optimize.curve_fit(model.evaluate, freqs, iqsF, p0, jac=model.jacobian)
+    else:
+        rv = scipy.optimize.curve_fit(mazinResonance, freqs, iqsF, p0)
     return rv
+
+def mazinResonanceComplex(x, q, f0, a, v, c, theta, gi, gq, ic, qc):
+    """
+    mazinResonance as complex values, with numpy broadcasting of x and the parameters.
+
+    For example, x of shape (nf, nTones) and parameters of shape (nTones,) evaluate all tones at once.
+    """
+    dx = (x-f0)/f0
+    z = (2j*q)*dx
+    f = z/(1+z) - 0.5 + c*dx + a*(1-np.exp((1j*v)*dx))
+    f1 = gi*f.real + (1j*gq)*f.imag
+    return f1*np.exp(1j*theta) + (ic + 1j*qc)
+
+def mazinResonanceDerivatives(x, q, f0, a, v, c, theta, gi, gq, ic, qc):
+    """
+    Derivatives of mazinResonanceComplex with respect to (q, f0, a, v, c, theta, gi, gq, ic, qc).
+
+    Returns complex values, with the parameter index as the last axis.
+    """
+    x, q, f0, a, v, c, theta, gi, gq, ic, qc = np.broadcast_arrays(x, q, f0, a, v, c, theta, gi, gq, ic, qc)
+    dx = (x-f0)/f0
+    z = (2j*q)*dx
+    ev = np.exp((1j*v)*dx)
+    rot = np.exp(1j*theta)
+    f = z/(1+z) - 0.5 + c*dx + a*(1-ev)
+    ddz = 1/(1+z)**2
+
+    # Derivatives of f, propagated through the I/Q gains and rotation.
+    dfs = [(2j*dx)*ddz,                                    # q
+           ((2j*q)*ddz + c - (1j*a*v)*ev)*(-x/f0**2),      # f0
+           1-ev,                                           # a
+           (-1j*a)*dx*ev,                                  # v
+           dx]                                             # c
+    retval = np.empty(x.shape+(10,), dtype=complex)
+    for i, df in enumerate(dfs):
+        retval[...,i] = (gi*df.real + (1j*gq)*df.imag)*rot
+    retval[...,5] = (1j*rot)*(gi*f.real + (1j*gq)*f.imag)  # theta
+    retval[...,6] = f.real*rot                              # gi
+    retval[...,7] = (1j*f.imag)*rot                         # gq
+    retval[...,8] = 1                                       # ic
+    retval[...,9] = 1j                                      # qc
+    return retval
+
+def firstGuessBatch(freqs, iqs):
+    """
+    firstGuess for many resonators at once.
+
+    freqs and iqs are (nf, nTones) arrays (freqs can also be (nf,) when shared), with increasing
+    frequency along the first axis, as returned by Scan.sweep_tones.
+
+    Returns an (nTones, 10) array of parameters, in the order used by mazinResonance.
+    """
+    iqs = np.asarray(iqs)
+    fa = np.broadcast_to(np.asarray(freqs, dtype=float).reshape((len(iqs),-1)), iqs.shape)
+    ia = iqs.real
+    qa = iqs.imag
+
+    # The gains are the diameter of the loop, the center is the average of the min,max values.
+    gi = ia.max(axis=0) - ia.min(axis=0)
+    gq = qa.max(axis=0) - qa.min(axis=0)
+    ic = 0.5*(ia.max(axis=0)+ia.min(axis=0))
+    qc = 0.5*(qa.max(axis=0)+qa.min(axis=0))
+
+    # Weights: iq velocity vs frequency (unweighted if the loop does not move).
+    iqv = np.hypot(ia[:-1]-ia[1:], qa[:-1]-qa[1:])
+    wsum = iqv.sum(axis=0)
+    iqv = np.where(wsum > 0, iqv, 1)
+    wsum = iqv.sum(axis=0)
+    ff = 0.5*(fa[:-1]+fa[1:])
+    fc = (ff*iqv).sum(axis=0)/wsum
+    std = np.sqrt(((ff-fc)**2*iqv).sum(axis=0)/wsum)
+    q = fc/std
+
+    # Theta from the weighted average of the values interpolated at ff.
+    wia = (0.5*(ia[:-1]+ia[1:])*iqv).sum(axis=0)/wsum
+    wqa = (0.5*(qa[:-1]+qa[1:])*iqv).sum(axis=0)/wsum
+    theta = np.pi/2.0 + np.arctan2(wia-ic, -(wqa-qc))
+    theta = np.where(theta < 0, theta + 2.0*np.pi, theta)
+
+    # These are guesses that seem to work.
+    ones = np.ones_like(fc)
+    return np.stack([q, fc, 0.1*ones, -5000*ones, -2*ones, theta, gi, gq, ic, qc], axis=-1)
+
+def fitResonances(freqs, iqs, p0=None, maxIter=1100, ftol=1.49012e-8, xtol=1.49012e-8, refitCost=1.2, maxCost=2.0, full_output=False):
+    """
+    Fit all the resonances of a multi-tone sweep at once.
+
+    All fits run together as a stacked Levenberg-Marquardt, with the analytic Jacobian of
+    mazinResonance. Each resonator keeps its own damping and stops when it converges.
+
+    The stacked fit and curve_fit can end in different local minima, so the tones that did not
+    converge, or whose cost is above refitCost times the median cost of the sweep, are fit
+    again with curve_fit from firstGuess, and the result with the lower cost is kept. Fits that
+    still have a cost above maxCost times the median cost have failed.
+
+    Parameters:
+    -----------
+        freqs : ndarray of floats
+            (nf, nTones) frequencies, or (nf,) if the same for all tones
+        iqs : ndarray of complex
+            (nf, nTones) measured values, e.g. from Scan.sweep_tones
+        p0 : ndarray of floats or None
+            (nTones, 10) starting parameters, or None to use firstGuessBatch
+        maxIter : int
+            maximum number of iterations (default: the maxfev of curve_fit for 10 parameters)
+        ftol, xtol : float
+            relative tolerance on the cost and on the parameters
+        refitCost : float or None
+            fit again with curve_fit the tones with a cost above refitCost times the median cost;
+            None to keep the results of the stacked fit
+        maxCost : float or None
+            fits with a cost above maxCost times the median cost have failed; None to accept them
+        full_output : bool
+            also return a dictionary with fit information
+
+    Returns:
+    --------
+        popt : ndarray of floats
+            (nTones, 10) fitted parameters, in the order used by mazinResonance, NaN for failed fits
+        pcov : ndarray of floats
+            (nTones, 10, 10) covariance of the parameters, as calculated by curve_fit
+        success : ndarray of bool
+            (nTones,) True for the fits that converged with an acceptable cost
+        info : dict (if full_output)
+            'cost' (sum of squared residuals), 'nit' (iterations of the stacked fit) and
+            'refit' (fit again with curve_fit) per tone
+    """
+    iqs = np.asarray(iqs)
+    nf, nTones = iqs.shape
+    freqs = np.broadcast_to(np.asarray(freqs, dtype=float).reshape((nf,-1)), iqs.shape)
+    x = freqs.T
+    y = iqs.T
+    if p0 is None:
+        p0 = firstGuessBatch(freqs, iqs)
+    p = np.array(p0, dtype=float).reshape((nTones, 10))
+
+    def residuals(x, y, p):
+        r = mazinResonanceComplex(x, *p.T[:,:,None]) - y
+        return np.concatenate((r.real, r.imag), axis=-1)
+
+    def jacobian(x, p):
+        d = mazinResonanceDerivatives(x, *p.T[:,:,None])
+        return np.concatenate((d.real, d.imag), axis=-2)
+
+    r = residuals(x, y, p)
+    cost = (r**2).sum(axis=-1)
+    jac = jacobian(x, p)
+    lam = np.full(nTones, 1e-3)
+    nu = np.full(nTones, 2.0)
+    nit = np.zeros(nTones, dtype=int)
+    active = np.isfinite(cost)
+    converged = np.zeros(nTones, dtype=bool)
+    diag = np.arange(10)
+    origin = np.zeros_like(p)
+    origin[:,1] = p[:,1]
+
+    for it in range(maxIter):
+        idx = np.flatnonzero(active)
+        if len(idx) == 0:
+            break
+
+        # Damped normal equations, with the columns of the Jacobian normalized.
+        J = jac[idx]
+        Jt = J.transpose(0,2,1)
+        JtJ = Jt @ J
+        g = (Jt @ r[idx,:,None])[...,0]
+        s = np.sqrt(JtJ[:,diag,diag])
+        s[s == 0] = 1
+        A = JtJ/(s[:,:,None]*s[:,None,:])
+        gs = g/s
+        A[:,diag,diag] += lam[idx,None]
+        try:
+            ds = -np.linalg.solve(A, gs[...,None])[...,0]
+        except np.linalg.LinAlgError:
+            ds = -np.array([np.linalg.lstsq(Ai, gi, rcond=None)[0] for Ai, gi in zip(A, gs)])
+        step = ds/s
+
+        pNew = p[idx] + step
+        rNew = residuals(x[idx], y[idx], pNew)
+        costNew = (rNew**2).sum(axis=-1)
+        nit[idx] += 1
+
+        # Gain ratio: actual over predicted reduction of the cost.
+        A[:,diag,diag] -= lam[idx,None]
+        pred = -2*(gs*ds).sum(axis=-1) - (ds*(A @ ds[...,None])[...,0]).sum(axis=-1)
+        actual = cost[idx] - costNew
+        rho = np.where(pred > 0, actual/np.where(pred > 0, pred, 1), -1)
+        better = (rho > 0) & np.isfinite(costNew)
+
+        # Convergence, as in MINPACK: small relative reduction, or small scaled step.
+        # f0 is taken relative to its starting value, so its size does not hide the step.
+        flat = better & (np.abs(actual) <= ftol*cost[idx]) & (pred <= ftol*cost[idx])
+        small = np.linalg.norm(ds, axis=-1) <= xtol*np.linalg.norm(s*(pNew-origin[idx]), axis=-1)
+
+        iBetter = idx[better]
+        p[iBetter] = pNew[better]
+        r[iBetter] = rNew[better]
+        cost[iBetter] = costNew[better]
+        if len(iBetter) > 0:
+            jac[iBetter] = jacobian(x[iBetter], p[iBetter])
+
+        # Damping update (Nielsen).
+        rb = rho[better]
+        lam[iBetter] *= np.maximum(1/3, 1-(2*rb-1)**3)
+        nu[iBetter] = 2
+        iWorse = idx[~better]
+        lam[iWorse] *= nu[iWorse]
+        nu[iWorse] *= 2
+
+        # Stop converged fits, and the ones that cannot improve any more.
+        done = flat | small | (lam[idx] > 1e16)
+        converged[idx[flat | small]] = True
+        active[idx[done]] = False
+
+    # Covariance, as scipy.optimize.curve_fit.
+    JtJ = jac.transpose(0,2,1) @ jac
+    dof = max(2*nf - 10, 1)
+    pcov = np.linalg.pinv(JtJ)*(cost/dof)[:,None,None]
+
+    # Fit the doubtful tones again with curve_fit, and keep the better result.
+    refit = ~converged
+    if refitCost is not None and converged.any():
+        refit |= cost > refitCost*np.median(cost[converged])
+    idx = np.flatnonzero(refit)
+    if len(idx) > 0:
+        popts, pcovs, ok = _fitChunk((freqs[:,idx], iqs[:,idx], [None]*len(idx)))
+        costs = np.full(len(idx), np.inf)
+        costs[ok] = (np.abs(mazinResonanceComplex(x[idx[ok]], *popts[ok].T[:,:,None]) - y[idx[ok]])**2).sum(axis=-1)
+        use = ok & (~converged[idx] | (costs < cost[idx]))
+        iUse = idx[use]
+        p[iUse] = popts[use]
+        pcov[iUse] = pcovs[use]
+        cost[iUse] = costs[use]
+        converged[iUse] = True
+    if maxCost is not None and converged.any():
+        converged &= cost <= maxCost*np.median(cost[converged])
+
+    # Failed fits, as in fitResonancesParallel.
+    p[~converged] = np.nan
+    pcov[~converged] = np.nan
+
+    if full_output:
+        return p, pcov, converged, {'cost' : cost, 'nit' : nit, 'refit' : refit}
+    return p, pcov, converged
+
+class FitCache():
+    """
+    Fitted parameters of resonators, indexed by a key (resonator id, nominal frequency, ...),
+    used as starting values when the same resonators are fit again.
+    """
+    def __init__(self):
+        self.dict = {}
+
+    def get(self, key):
+        return self.dict.get(key)
+
+    def update(self, keys, popts, success):
+        for key, popt, ok in zip(keys, popts, success):
+            if ok:
+                self.dict[key] = np.array(popt)
+
+    def clear(self):
+        self.dict = {}
+
+def _fitChunk(args):
+    """
+    Fit the resonators of a chunk with curve_fit, one at a time (worker of fitResonancesParallel).
+    """
+    freqs, iqs, p0s = args
+    popts = np.full((len(p0s), 10), np.nan)
+    pcovs = np.full((len(p0s), 10, 10), np.nan)
+    success = np.zeros(len(p0s), dtype=bool)
+    for i, p0 in enumerate(p0s):
+        iqsF = np.array([np.real(iqs[:,i]), np.imag(iqs[:,i])]).reshape((-1))
+
+        # Start from the previous fit if there is one, otherwise from firstGuess.
+        starts = [firstGuess(freqs[:,i], iqs[:,i])]
+        if p0 is not None:
+            starts.insert(0, p0)
+        for start in starts:
+            try:
+                popts[i], pcovs[i] = scipy.optimize.curve_fit(mazinResonance, freqs[:,i], iqsF, start)
+                success[i] = True
+                break
+            except (RuntimeError, ValueError):
+                pass
+    return popts, pcovs, success
+
+def fitResonancesParallel(freqs, iqs, keys=None, cache=None, nProcesses=None, chunkSize=None, executor=None):
+    """
+    Fit many resonances with curve_fit, spread over a pool of processes.
+
+    Parameters:
+    -----------
+        freqs : ndarray of floats
+            (nf, nTones) frequencies, or (nf,) if the same for all tones
+        iqs : ndarray of complex
+            (nf, nTones) measured values, e.g. from Scan.sweep_tones
+        keys : list or None
+            identifier of each resonator in the cache (default: tone number)
+        cache : FitCache or None
+            previous fits used as starting values. It is updated with the successful fits.
+        nProcesses : int or None
+            number of worker processes (default: number of cores)
+        chunkSize : int or None
+            number of resonators sent to a worker at once (default: 4 chunks per process)
+        executor : concurrent.futures.Executor or None
+            pool to use, so a re-tune loop can keep it between calls. If None, one is created.
+
+    Returns:
+    --------
+        popt : ndarray of floats
+            (nTones, 10) fitted parameters, NaN for failed fits
+        pcov : ndarray of floats
+            (nTones, 10, 10) covariance of the parameters
+        success : ndarray of bool
+            (nTones,) True for the fits that converged
+    """
+    iqs = np.asarray(iqs)
+    nf, nTones = iqs.shape
+    freqs = np.broadcast_to(np.asarray(freqs, dtype=float).reshape((nf,-1)), iqs.shape)
+    if keys is None:
+        keys = list(range(nTones))
+    if len(keys) != nTones:
+        raise ValueError("There are %d keys for %d tones" % (len(keys), nTones))
+
+    # Warm starts.
+    p0s = [None]*nTones
+    if cache is not None:
+        p0s = [cache.get(key) for key in keys]
+
+    # Chunks.
+    if nProcesses is None:
+        nProcesses = os.cpu_count() or 1
+    if chunkSize is None:
+        chunkSize = max(1, -(-nTones//(4*nProcesses)))
+    chunks = [(freqs[:,i:i+chunkSize], iqs[:,i:i+chunkSize], p0s[i:i+chunkSize])
+              for i in range(0, nTones, chunkSize)]
+
+    if executor is None:
+        with concurrent.futures.ProcessPoolExecutor(nProcesses) as pool:
+            results = list(pool.map(_fitChunk, chunks))
+    else:
+        results = list(executor.map(_fitChunk, chunks))
+
+    popt = np.concatenate([r[0] for r in results])
+    pcov = np.concatenate([r[1] for r in results])
+    success = np.concatenate([r[2] for r in results])
+
+    if cache is not None:
+        cache.update(keys, popt, success)
+
+    return popt, pcov, success
+
 def fitResonancePlot(freqs, iqs, p, iPlot):
     """
     See how the fit matches the data. iPlot=0 is a Bode plot; iPlot=1 is IQ plot
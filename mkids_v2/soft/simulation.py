@@ -0,0 +1,725 @@
+"""
+Hardware-free simulation of MkidsSoc.
+
+SimMkidsSoc reads one of the .hwh files shipped with the firmware, instantiates the
+regular drivers on top of an in-memory register file, emulates allocate() buffers,
+DMA channels and the RF data converter, and generates the streamer packets with a
+numerical model of the PFB/DDS/kidsim data path. MkidsSoc, KidsChain, SimuChain,
+Scan and the drivers can then be used on a computer without an RFSoC:
+
+    import simulation
+    from Scan import Scan
+
+    soc  = simulation.SimMkidsSoc('mkids_2x2_kidsim_v2', board='zcu216')
+    scan = Scan(soc)
+
+When qick/pynq are not installed, minimal stand-ins for the parts used by the drivers
+are registered before mkids is imported, so this module must be imported first.
+
+Data path model (per analysis channel of a dual chain):
+    * Tones are read back from the axis_dds_dual_v1 table: f = fmix + ch2freq(ch) + pinc*DF.
+    * Each tone lands on the analysis PFB channel closest to it (no leakage to neighbours).
+    * The tone goes through the resonators of the kidsim block of the simu chain with the
+      same index (notch of depth 1-c1 and linewidth set by the pole c0, sweep not modeled),
+      and through a cable delay, which adds a phase 2*pi*delay*f.
+    * The analysis side of the DDS table down-converts the channel and applies the
+      compensation gain, following the output selection of the channel.
+    * Gaussian noise is added and samples are quantized to int16.
+"""
+import asyncio
+import os
+import sys
+import time
+import types
+import xml.etree.ElementTree as ET
+from pathlib import Path
+
+import numpy as np
+
+def allocate(shape, dtype=np.uint32, **kwargs):
+    """
+    Emulation of pynq.allocate: a plain numpy array.
+    """
+    return np.zeros(shape, dtype=dtype)
+
+class SimMmio():
+    """
+    Emulated memory-mapped register file of an IP block (32-bit registers).
+    """
+    # Number of 32-bit registers emulated per block.
+    NREGS = 256
+
+    def __init__(self, hook=None):
+        self.array = np.zeros(self.NREGS, dtype=np.uint32)
+
+        # Function called as hook(index, value) after each write.
+        self.hook = hook
+
+    def read(self, offset=0, length=4):
+        return int(self.array[offset//4])
+
+    def write(self, offset, data):
+        index = offset//4
+        self.array[index] = int(data) & 0xFFFFFFFF
+        if self.hook is not None:
+            self.hook(index, int(self.array[index]))
+
+###################################################
+### Stand-ins for qick/pynq, used when missing. ###
+###################################################
+class _DefaultIP():
+    def __init__(self, description):
+        # The mmio may be created (with its hook) before the driver constructor runs.
+        if 'mmio' not in self.__dict__:
+            self.mmio = SimMmio()
+
+    def read(self, offset=0):
+        return self.mmio.read(offset)
+
+    def write(self, offset, value):
+        self.mmio.write(offset, value)
+
+class _SocIp(_DefaultIP):
+    REGISTERS = {}
+
+    def __init__(self, description, **kwargs):
+        super().__init__(description)
+        self.fullpath = description['fullpath']
+        self.type = description['type'].split(':')[-2]
+
+    def _registers(self):
+        return self.__dict__.get('REGISTERS', type(self).REGISTERS)
+
+    def __setattr__(self, a, v):
+        if a in self._registers():
+            self.mmio.write(4*self._registers()[a], int(v))
+        else:
+            super().__setattr__(a, v)
+
+    def __getattr__(self, a):
+        if a != 'REGISTERS' and a in self._registers():
+            return self.mmio.read(4*self._registers()[a])
+        raise AttributeError("'%s' object has no attribute '%s'" % (type(self).__name__, a))
+
+class _Overlay():
+    pass
+
+class _QickConfig():
+    def __init__(self, cfg=None):
+        if cfg is not None:
+            self._cfg = cfg
+
+    def __getitem__(self, key):
+        return self._cfg[key]
+
+    def __setitem__(self, key, val):
+        self._cfg[key] = val
+
+class _QickSoc():
+    pass
+
+class _QickMetadata():
+    pass
+
+class _RFdc():
+    def __init__(self, description):
+        pass
+
+def _install_stand_ins():
+    """
+    Register minimal pynq/xrfdc/qick.qick modules, for the ones that cannot be imported.
+    """
+    try:
+        import pynq.buffer
+    except ImportError:
+        pynq_ = types.ModuleType('pynq')
+        buffer_ = types.ModuleType('pynq.buffer')
+        buffer_.allocate = allocate
+        pynq_.buffer = buffer_
+        pynq_.allocate = allocate
+        pynq_.Overlay = _Overlay
+        pynq_.DefaultIP = _DefaultIP
+        sys.modules['pynq'] = pynq_
+        sys.modules['pynq.buffer'] = buffer_
+
+    try:
+        import xrfdc
+    except ImportError:
+        xrfdc = types.ModuleType('xrfdc')
+        xrfdc.RFdc = _RFdc
+        xrfdc.EVENT_MIXER = 1
+        sys.modules['xrfdc'] = xrfdc
+
+    qick_ = sys.modules.get('qick')
+    if qick_ is None:
+        qick_ = types.ModuleType('qick')
+        qick_.__path__ = []
+        sys.modules['qick'] = qick_
+    qq = types.ModuleType('qick.qick')
+    qq.os = os
+    qq.np = np
+    qq.xrfdc = xrfdc
+    qq.Overlay = _Overlay
+    qq.SocIp = _SocIp
+    qq.QickConfig = _QickConfig
+    qq.QickSoc = _QickSoc
+    qq.QickMetadata = _QickMetadata
+    qick_.qick = qq
+    sys.modules['qick.qick'] = qq
+
+try:
+    import qick.qick
+    standIns = False
+except ImportError:
+    _install_stand_ins()
+    standIns = True
+
+from mkids import *
+import drivers.misc
+
+# Without a board, streamer buffers are plain arrays (pynq may be installed without one).
+# With the real qick, the drivers keep the real allocate.
+if standIns:
+    drivers.misc.allocate = allocate
+
+def _signed(value, bits=32):
+    """
+    Interpret the lower bits of a register value as a two's complement number.
+    """
+    value = np.asarray(value, dtype=np.int64) & ((1 << bits) - 1)
+    return np.where(value >= (1 << (bits-1)), value - (1 << bits), value)
+
+class SimMetadata():
+    """
+    Connectivity information from a .hwh file, with the interface of QickMetadata used by the drivers.
+    """
+    def __init__(self, hwh):
+        root = ET.parse(hwh).getroot()
+
+        # Dictionary with module information, indexed by instance name.
+        self.dict = {}
+
+        # Bus name for each (instance, port), and the endpoints of each bus.
+        self.ports = {}
+        self.busses = {}
+
+        for m in root.iter('MODULE'):
+            inst = m.get('INSTANCE')
+            params = {}
+            if m.find('PARAMETERS') is not None:
+                for p in m.find('PARAMETERS'):
+                    params[p.get('NAME')] = p.get('VALUE')
+            self.dict[inst] = {'modtype' : m.get('MODTYPE'),
+                               'vlnv'    : m.get('VLNV'),
+                               'modclass': m.get('MODCLASS'),
+                               'params'  : params}
+
+            if m.find('BUSINTERFACES') is not None:
+                for b in m.find('BUSINTERFACES'):
+                    bus = b.get('BUSNAME')
+                    if bus is None or bus == '__NOC__':
+                        continue
+                    self.ports[(inst, b.get('NAME').lower())] = (bus, b.get('NAME'))
+                    self.busses.setdefault(bus, []).append((inst, b.get('NAME')))
+
+    def trace_bus(self, blockname, portname):
+        bus, port = self.ports[(blockname, portname.lower())]
+        return [(b, p) for b, p in self.busses[bus] if (b, p) != (blockname, port)]
+
+    def mod2type(self, blockname):
+        return self.dict[blockname]['modtype']
+
+    def get_param(self, blockname, parname):
+        return self.dict[blockname]['params'][parname]
+
+class SimRfBlock():
+    """
+    Emulated ADC/DAC block of the RF data converter.
+    """
+    def __init__(self, mode):
+        self.MixerSettings = {'MixerMode'   : mode,
+                              'MixerType'   : 2,   # Fine mixer.
+                              'EventSource' : 2,   # Tile event.
+                              'Freq'        : 0.0,
+                              'PhaseOffset' : 0.0,
+                              'CoarseMixFreq' : 0}
+        self.NyquistZone = 1
+
+    def UpdateEvent(self, event):
+        pass
+
+class SimRfTile():
+    def __init__(self, mode):
+        self.blocks = [SimRfBlock(mode) for i in range(4)]
+
+class SimRfdc():
+    """
+    Emulated RF data converter. Mixer and Nyquist zone methods are the ones of the RFDC driver.
+    """
+    configure       = RFDC.configure
+    set_mixer_freq  = RFDC.set_mixer_freq
+    get_mixer_freq  = RFDC.get_mixer_freq
+    set_nyquist     = RFDC.set_nyquist
+    get_nyquist     = RFDC.get_nyquist
+
+    def __init__(self, description):
+        self.fullpath = description['fullpath']
+        self.adc_tiles = [SimRfTile(AnalysisChain.mixer_dict['mode']['real2ccomplex']) for i in range(4)]
+        self.dac_tiles = [SimRfTile(AnalysisChain.mixer_dict['mode']['complex2real']) for i in range(4)]
+
+        # Dictionary for configuration.
+        self.dict = {}
+        self.dict['nqz']  = {'adc' : {}, 'dac' : {}}
+        self.dict['freq'] = {'adc' : {}, 'dac' : {}}
+
+class SimDmaChannel():
+    """
+    Emulated DMA receive channel: the buffer is filled by the data path model on transfer().
+    """
+    def __init__(self, soc):
+        self.soc = soc
+
+        # Analysis chain connected to this channel (set by SimMkidsSoc).
+        self.chain = None
+
+        self.idle = True
+        self.t_done = 0
+
+    def transfer(self, array, start=0, nbytes=0):
+        duration = self.soc.model.fill(self.chain, array)
+        self.t_done = time.monotonic() + duration
+        self.idle = False
+
+    def wait(self):
+        if self.soc.model.realtime:
+            dt = self.t_done - time.monotonic()
+            if dt > 0:
+                time.sleep(dt)
+        self.idle = True
+
+    async def wait_async(self):
+        if self.soc.model.realtime:
+            dt = self.t_done - time.monotonic()
+            if dt > 0:
+                await asyncio.sleep(dt)
+        self.idle = True
+
+class SimDma():
+    """
+    Emulated AXI DMA (receive side only).
+    """
+    def __init__(self, description, soc):
+        self.fullpath = description['fullpath']
+        self.recvchannel = SimDmaChannel(soc)
+
+class SimIp():
+    """
+    Emulated IP logic. The base class is a plain register file.
+    """
+    def __init__(self, ip):
+        self.ip = ip
+
+    def reg(self, name):
+        return int(self.ip.mmio.array[self.ip.REGISTERS[name]])
+
+    def write(self, index, value):
+        pass
+
+class SimDdsDual(SimIp):
+    """
+    axis_dds_dual_v1: channel table latched on the WE pulse.
+    """
+    def __init__(self, ip):
+        super().__init__(ip)
+        self.table = None
+
+    def write(self, index, value):
+        if index != self.ip.REGISTERS['addr_we_reg'] or value != 1:
+            return
+
+        if self.table is None:
+            self.table = {}
+            for k in ['pinc', 'phase', 'gain', 'cgi', 'cgq']:
+                self.table[k] = np.zeros(self.ip.NCH_TOTAL, dtype=np.int64)
+            self.table['cfg'] = np.full(self.ip.NCH_TOTAL, 4, dtype=np.int64)
+
+        ch = self.reg('addr_nchan_reg')
+        cg = int(_signed(self.reg('addr_comp_gain_reg')))
+        cgi = int(_signed(cg, 16))
+        self.table['pinc'][ch]  = _signed(self.reg('addr_pinc_reg'))
+        self.table['phase'][ch] = self.reg('addr_phase_reg')
+        self.table['gain'][ch]  = _signed(self.reg('addr_dds_gain_reg'))
+        self.table['cgi'][ch]   = cgi
+        self.table['cgq'][ch]   = (cg - cgi) >> 16
+        self.table['cfg'][ch]   = self.reg('addr_cfg_reg')
+
+class SimChselV2(SimIp):
+    """
+    axis_chsel_pfb_v2: transaction mask written word by word on the WE pulse.
+    """
+    def __init__(self, ip):
+        super().__init__(ip)
+        self.mask = {}
+
+    def write(self, index, value):
+        if index == self.ip.REGISTERS['we_reg'] and value == 1:
+            self.mask[self.reg('addr_reg')] = self.reg('data_reg')
+
+    def transactions(self):
+        trans = [32*addr + bit for addr, word in self.mask.items() for bit in range(32) if (word >> bit) & 1]
+        return np.array(sorted(trans), dtype=np.int64)
+
+class SimChselV3(SimIp):
+    """
+    axis_chsel_pfb_v3: transaction mask in a single register.
+    """
+    def transactions(self):
+        word = self.reg('punct_reg')
+        return np.array([bit for bit in range(32) if (word >> bit) & 1], dtype=np.int64)
+
+class SimKidsim(SimIp):
+    """
+    axis_kidsim_v3: resonator configuration latched on the WE pulse.
+    """
+    def __init__(self, ip):
+        super().__init__(ip)
+
+        # (channel) -> dds_freq, c0, c1, outsel.
+        self.resonators = {}
+
+    def write(self, index, value):
+        if index != self.ip.REGISTERS['we_reg'] or value != 1:
+            return
+
+        ch = self.reg('punct_id_reg')*self.ip.L + self.reg('addr_reg')
+        self.resonators[ch] = {'dds_freq' : int(_signed(self.reg('dds_freq_reg'))),
+                               'c0'       : _signed(self.reg('iir_c0_reg'), 16)/2**(self.ip.B_COEF-1),
+                               'c1'       : _signed(self.reg('iir_c1_reg'), 16)/2**(self.ip.B_COEF-1),
+                               'outsel'   : self.reg('outsel_reg')}
+
+class SimDataPath():
+    """
+    Numerical model of the data path, used to fill the DMA buffers.
+    """
+    def __init__(self, soc, delay=0, noise=2.0, amplitude=10000.0, loopback=True, realtime=False, seed=None):
+        self.soc = soc
+
+        # Cable delay (us), added as a phase 2*pi*delay*f.
+        self.delay = delay
+
+        # RMS noise of I and Q (ADC units).
+        self.noise = noise
+
+        # Output amplitude (ADC units) of a tone of gain 1.
+        self.amplitude = amplitude
+
+        # Tones go through the kidsim resonators of the simu chain.
+        self.loopback = loopback
+
+        # DMA wait() returns after the acquisition time of the buffer.
+        self.realtime = realtime
+
+        self.rng = np.random.default_rng(seed)
+
+    def tones(self, chain):
+        """
+        Tones generated by the synthesis side of a dual chain.
+
+        Returns:
+        --------
+            f, a, phi : ndarrays
+                frequency (MHz), amplitude and phase (rad) of the active channels
+        """
+        soc = self.soc
+        emu = soc.sim[chain['dds']]
+        if emu.table is None:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+
+        for dual in soc['dual']:
+            if dual['analysis'] is chain:
+                synthesis = dual['synthesis']
+                break
+        else:
+            return np.zeros(0), np.zeros(0), np.zeros(0)
+
+        dds = getattr(soc, chain['dds'])
+        pfb = getattr(soc, synthesis['pfb'])
+        chs = np.flatnonzero(emu.table['gain'])
+        fmix = soc.rf.get_mixer_freq(synthesis['dac']['id'], 'dac')
+
+        f   = fmix + pfb.ch2freq(chs) + emu.table['pinc'][chs]*dds.DF_DDS/1e6
+        a   = emu.table['gain'][chs]/2**(dds.B_GAIN-1)
+        phi = np.radians(emu.table['phase'][chs]*dds.DFI_DDS)
+
+        return f, a, phi
+
+    def response(self, chain, f):
+        """
+        Transfer function of the loopback at frequencies f (MHz).
+        """
+        soc = self.soc
+        h = np.exp(2j*np.pi*self.delay*f)
+
+        if not self.loopback:
+            return h
+
+        idx = [i for i, dual in enumerate(soc['dual']) if dual['analysis'] is chain]
+        if len(idx) == 0 or idx[0] >= len(soc['simu']):
+            return h
+
+        simu = soc['simu'][idx[0]]['analysis']
+        emu = soc.sim[simu['kidsim']]
+        kidsim = getattr(soc, simu['kidsim'])
+        pfb = getattr(soc, simu['pfb'])
+        fmix = abs(soc.rf.get_mixer_freq(simu['adc']['id'], 'adc'))
+        fb = pfb.dict['freq']['fb']
+
+        for ch, res in emu.resonators.items():
+            if res['outsel'] == 0:
+                f0 = fmix + pfb.ch2freq(ch) + res['dds_freq']*kidsim.DF_DDS/1e6
+                w = 2*np.pi*(f-f0)/fb
+                h = h*(1 - res['c1']*(1-res['c0'])/(1-res['c0']*np.exp(-1j*w)))
+            elif res['outsel'] == 3:
+                f0 = fmix + pfb.ch2freq(ch)
+                h = np.where(abs(f-f0) < pfb.dict['freq']['fc']/2, 0, h)
+
+        return h
+
+    def channels(self, chain, chs, ns):
+        """
+        Output samples of analysis channels chs.
+
+        Returns:
+        --------
+            x : ndarray of complex
+                (len(chs), ns) samples, in ADC units
+            fs : float
+                sampling frequency of each channel (MHz)
+        """
+        soc = self.soc
+        pfb = getattr(soc, chain['pfb'])
+        dds = getattr(soc, chain['dds'])
+        emu = soc.sim[chain['dds']]
+        N  = pfb.dict['N']
+        fc = pfb.dict['freq']['fc']
+
+        # Output sampling frequency.
+        fs = pfb.dict['freq']['fb']
+        if chain['cic'] is not None:
+            fs /= max(getattr(soc, chain['cic']).cic_d_reg, 1)
+        t = np.arange(ns)/fs
+
+        x = self.noise*(self.rng.standard_normal((len(chs), ns)) + 1j*self.rng.standard_normal((len(chs), ns)))
+
+        f, a, phi = self.tones(chain)
+        if len(f) == 0:
+            return x, fs
+
+        # Input channel of each tone.
+        fmix = abs(soc.rf.get_mixer_freq(chain['adc']['id'], 'adc'))
+        f_ = f - fmix
+        k = np.mod(np.round(f_/fc).astype(np.int64), N)
+        pos = np.full(N, -1)
+        pos[chs] = np.arange(len(chs))
+        sel = pos[k] >= 0
+        if not np.any(sel):
+            return x, fs
+        f, a, phi, f_, k = f[sel], a[sel], phi[sel], f_[sel], k[sel]
+
+        # Channel input, relative to the channel center.
+        fin = f_ - pfb.ch2freq(k)
+        xin = self.amplitude*a*self.response(chain, f)*np.exp(1j*phi)
+
+        # Down-conversion, output selection and compensation.
+        fdds = emu.table['pinc'][k]*dds.DF_DDS/1e6
+        cfg  = emu.table['cfg'][k]
+        outsel = cfg & 3
+        fout = np.where(outsel == 0, fin - fdds, np.where(outsel == 1, -fdds, fin))
+        xin  = np.where(outsel == 1, self.amplitude, xin)
+        xin  = np.where(outsel == 3, 0, xin)
+        cg   = (emu.table['cgi'][k] + 1j*emu.table['cgq'][k])/2**15
+        xin  = np.where((cfg & 4) == 0, xin*cg, xin)
+
+        np.add.at(x, pos[k], xin[:,None]*np.exp(2j*np.pi*fout[:,None]*t))
+        return x, fs
+
+    def fill(self, chain, buff):
+        """
+        Fill a streamer DMA buffer with packets of the enabled transactions.
+
+        Returns:
+        --------
+            duration : float
+                acquisition time of the buffer (s)
+        """
+        soc = self.soc
+        streamer = getattr(soc, chain['streamer'])
+        chsel = getattr(soc, chain['chsel'])
+        L = chsel.L
+
+        packets = np.asarray(buff).reshape((-1, streamer.NS_TR))
+        packets[:] = 0
+        nsamp = min(streamer.nsamp_reg, len(packets))
+
+        trans = soc.sim[chain['chsel']].transactions()
+        if len(trans) == 0 or nsamp == 0:
+            return 0
+
+        # Transactions are output in order, once per frame.
+        ntran = len(trans)
+        nper = -(-nsamp//ntran)
+        chs = (trans[:,None]*L + np.arange(L)).reshape(-1)
+        x, fs = self.channels(chain, chs, nper)
+        x = x.reshape((ntran, L, nper))
+
+        rows = np.arange(nsamp)
+        xs = x[rows % ntran, :, rows//ntran]
+        packets[:nsamp, 0:2*L:2] = np.clip(np.round(xs.real), -2**15, 2**15-1)
+        packets[:nsamp, 1:2*L:2] = np.clip(np.round(xs.imag), -2**15, 2**15-1)
+        packets[:nsamp, streamer.NS] = trans[rows % ntran]
+
+        return nper/fs/1e6
+
+class SimMkidsSoc(MkidsSoc):
+    """
+    MkidsSoc built from a .hwh file, with emulated hardware.
+    """
+    # Nominal delay (us) of the firmware, as used by Scan.
+    DELAYS = {('zcu216', 'mkids_2x2_kidsim_v2') : -8.51,
+              ('rfsoc4x2', 'mkids_v3')          : -4.262}
+
+    # Emulated logic for IP types.
+    EMULATORS = {'axis_dds_dual_v1'  : SimDdsDual,
+                 'axis_chsel_pfb_v2' : SimChselV2,
+                 'axis_chsel_pfb_v3' : SimChselV3,
+                 'axis_kidsim_v3'    : SimKidsim}
+
+    # Constructor.
+    def __init__(self, firmware='mkids_2x2_kidsim_v2', board='zcu216', delay=None, noise=2.0, amplitude=10000.0, loopback=True, realtime=False, seed=None):
+        """
+        Parameters:
+        -----------
+            firmware : str
+                firmware name (e.g. 'mkids_v3') or path of a .hwh file
+            board : str
+                board directory of the firmware ('zcu216', 'rfsoc4x2', ...)
+            delay : float or None
+                cable delay (us). None for the nominal delay of the firmware (or 0)
+            noise : float
+                RMS noise of I and Q (ADC units)
+            amplitude : float
+                output amplitude (ADC units) of a tone of gain 1
+            loopback : bool
+                send the tones through the kidsim resonators of the simu chain
+            realtime : bool
+                DMA transfers take the acquisition time of the buffer
+            seed : int or None
+                seed of the noise generator
+        """
+        # Firmware file.
+        if firmware.endswith('.hwh'):
+            hwh = Path(firmware)
+        else:
+            hwh = Path(__file__).resolve().parent.parent.joinpath(board, firmware + '.hwh')
+        if not hwh.is_file():
+            raise RuntimeError("hwh file %s not found" % hwh)
+
+        self.bitfile_name = str(hwh.with_suffix('.bit'))
+        os.environ.setdefault("BOARD", board.upper())
+
+        # Initialize the configuration
+        self._cfg = {}
+        QickConfig.__init__(self)
+
+        self['board'] = os.environ["BOARD"]
+        if self['board'] == "ZCU208":
+            self['board'] = "ZCU216"
+
+        # Connectivity and parameters.
+        self.metadata = SimMetadata(hwh)
+        self.ip_dict = self.sim_ip_dict()
+
+        # Read the config to get a list of enabled ADCs and DACs, and the sampling frequencies.
+        self.list_rf_blocks(
+            self.ip_dict['usp_rf_data_converter_0']['parameters'])
+
+        # Data path model.
+        if delay is None:
+            delay = self.DELAYS.get((board.lower(), hwh.stem), 0)
+        self.model = SimDataPath(self, delay=delay, noise=noise, amplitude=amplitude,
+                                 loopback=loopback, realtime=realtime, seed=seed)
+
+        # Instantiate drivers.
+        self.sim = {}
+        for name, description in self.ip_dict.items():
+            setattr(self, name, self.sim_driver(description))
+
+        # RF data converter (for configuring ADCs and DACs, and setting NCOs)
+        self.rf = self.usp_rf_data_converter_0
+        self.rf.configure(self)
+
+        self.map_signal_paths()
+
+        # Connect DMA channels to the analysis chains.
+        for chain in self['analysis']:
+            if 'dma' in chain:
+                getattr(self, chain['dma']).recvchannel.chain = chain
+
+    def sim_ip_dict(self):
+        """
+        Build the ip_dict of the overlay, with the drivers that will be emulated.
+        """
+        drivers = {}
+        for obj in globals().values():
+            if isinstance(obj, type) and issubclass(obj, SocIp) and 'bindto' in obj.__dict__:
+                for vlnv in obj.bindto:
+                    drivers[vlnv] = obj
+
+        ip_dict = {}
+        for name, mod in self.metadata.dict.items():
+            if mod['modtype'] == 'usp_rf_data_converter':
+                driver = SimRfdc
+            elif mod['modtype'] == 'axi_dma':
+                driver = SimDma
+            elif mod['vlnv'] in drivers:
+                driver = drivers[mod['vlnv']]
+            else:
+                continue
+
+            ip_dict[name] = {'fullpath'   : name,
+                             'type'       : mod['vlnv'],
+                             'parameters' : mod['params'],
+                             'driver'     : driver}
+
+        return ip_dict
+
+    def sim_driver(self, description):
+        """
+        Instantiate the driver of a block on top of an emulated register file.
+        """
+        cls = description['driver']
+        if cls is SimDma:
+            return SimDma(description, self)
+        if cls is SimRfdc:
+            return SimRfdc(description)
+
+        # Create the register file (and its logic) before running the driver constructor,
+        # as constructors already program the block.
+        ip = cls.__new__(cls)
+        emu = self.EMULATORS.get(self.metadata.mod2type(description['fullpath']), SimIp)(ip)
+        self.sim[description['fullpath']] = emu
+        object.__setattr__(ip, 'mmio', SimMmio(hook=emu.write))
+
+        base = [c for c in cls.__mro__ if c.__name__ == 'DefaultIP']
+        if len(base) == 0:
+            cls.__init__(ip, description)
+        else:
+            # pynq is installed: keep DefaultIP from mapping physical memory.
+            init = base[0].__init__
+            base[0].__init__ = lambda self, description, *args, **kwargs: None
+            try:
+                cls.__init__(ip, description)
+            finally:
+                base[0].__init__ = init
+
+        return ip
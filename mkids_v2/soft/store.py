@@ -0,0 +1,247 @@
+"""
+Append-only, memory-mapped storage for sweeps and timestreams.
+
+A store is a directory:
+
+    meta.json          metadata of the scan (mixer, tones, delay, ...) and the datasets
+    <name>.<k>.npy     chunk k of dataset <name>, chunkRows rows, created when first written
+    <name>.nrows       number of rows of dataset <name>
+
+Rows are written straight into memory-mapped .npy chunks, so only the pages being written
+are in memory, whatever the length of the scan. Any row range, and any tone, can be read
+back without loading the rest of the dataset. Each append only rewrites the small row
+count file, after the data are flushed, so a store interrupted by a crash stays readable;
+meta.json is rewritten when datasets or metadata change, and by close().
+
+    store = DataStore('scan-001', mode='a')
+    xs = kids.sweep_tones(bandwidth, nf, store=store)
+    store.read('xs', tones=[3])
+"""
+import os
+import json
+import numpy as np
+
+def _encode(value):
+    """
+    Convert numpy values into JSON-able values (see _decode).
+    """
+    if isinstance(value, dict):
+        return {k : _encode(v) for k,v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [_encode(v) for v in value]
+    if isinstance(value, (np.ndarray, np.generic, complex)):
+        a = np.asarray(value)
+        if np.iscomplexobj(a):
+            return {'__ndarray__' : 'complex', 'real' : a.real.tolist(), 'imag' : a.imag.tolist()}
+        return {'__ndarray__' : str(a.dtype), 'data' : a.tolist()}
+    return value
+
+def _decode(value):
+    if isinstance(value, dict):
+        if '__ndarray__' in value:
+            if value['__ndarray__'] == 'complex':
+                return np.array(value['real']) + 1j*np.array(value['imag'])
+            return np.array(value['data'], dtype=value['__ndarray__'])
+        return {k : _decode(v) for k,v in value.items()}
+    if isinstance(value, list):
+        return [_decode(v) for v in value]
+    return value
+
+class DataStore():
+    """
+    Directory of append-only, memory-mapped datasets with scan metadata.
+    """
+    META = 'meta.json'
+    # Default size of a chunk file.
+    CHUNK_BYTES = 64*1024*1024
+
+    def __init__(self, path, mode='r'):
+        """
+        Parameters:
+        -----------
+            path : str
+                directory of the store
+            mode : str
+                'r' to read, 'a' to append (the store is created if needed)
+        """
+        if mode not in ['r', 'a']:
+            raise ValueError("mode must be 'r' or 'a', not %s" % mode)
+        self.path = path
+        self.mode = mode
+
+        # Chunk being written, per dataset.
+        self.chunks = {}
+
+        metaPath = os.path.join(path, self.META)
+        if os.path.exists(metaPath):
+            with open(metaPath) as f:
+                self.dict = _decode(json.load(f))
+            # The row count files are more recent than meta.json.
+            for name, ds in self.dict['datasets'].items():
+                if os.path.exists(self.nrows_path(name)):
+                    with open(self.nrows_path(name)) as f:
+                        ds['nrows'] = int(f.read())
+        elif mode == 'a':
+            os.makedirs(path, exist_ok=True)
+            self.dict = {'meta' : {}, 'datasets' : {}}
+            self.write_meta()
+        else:
+            raise ValueError("%s is not a DataStore" % path)
+
+    @property
+    def meta(self):
+        return self.dict['meta']
+
+    @property
+    def datasets(self):
+        return list(self.dict['datasets'].keys())
+
+    def check_writable(self):
+        if self.mode != 'a':
+            raise ValueError("DataStore %s is read-only" % self.path)
+
+    def write_meta(self):
+        # Write a new file, then rename, so meta.json is never partially written.
+        metaPath = os.path.join(self.path, self.META)
+        with open(metaPath + '.tmp', 'w') as f:
+            json.dump(_encode(self.dict), f, indent=1)
+        os.replace(metaPath + '.tmp', metaPath)
+
+    def nrows_path(self, name):
+        return os.path.join(self.path, "%s.nrows" % name)
+
+    def write_nrows(self, name):
+        # Same as write_meta(), for the row count of a dataset.
+        path = self.nrows_path(name)
+        with open(path + '.tmp', 'w') as f:
+            f.write(str(self.dict['datasets'][name]['nrows']))
+        os.replace(path + '.tmp', path)
+
+    def set_meta(self, **kwargs):
+        """
+        Add or update scan metadata (numbers, strings, lists or numpy arrays).
+        """
+        self.check_writable()
+        self.dict['meta'].update(kwargs)
+        self.write_meta()
+
+    def create(self, name, shape, dtype=complex, chunkRows=None, meta=None):
+        """
+        Create a dataset.
+
+        Parameters:
+        -----------
+            name : str
+                dataset name
+            shape : tuple of int
+                shape of one row, for example (ntones,) for a sweep with mean=True
+            dtype : numpy dtype
+                type of the values
+            chunkRows : int
+                number of rows per file; default None for files of about CHUNK_BYTES
+            meta : dict
+                metadata of the dataset
+        """
+        self.check_writable()
+        if name in self.dict['datasets']:
+            raise ValueError("Dataset %s already exists in %s" % (name, self.path))
+        if chunkRows is None:
+            rowBytes = np.dtype(dtype).itemsize*int(np.prod(shape))
+            chunkRows = max(1, self.CHUNK_BYTES//max(rowBytes, 1))
+        self.dict['datasets'][name] = {'shape'     : list(shape),
+                                       'dtype'     : np.dtype(dtype).str,
+                                       'chunkRows' : int(chunkRows),
+                                       'nrows'     : 0,
+                                       'meta'      : {} if meta is None else meta}
+        self.write_meta()
+
+    def nrows(self, name):
+        return self.dict['datasets'][name]['nrows']
+
+    def chunk_path(self, name, k):
+        return os.path.join(self.path, "%s.%d.npy" % (name, k))
+
+    def chunk(self, name, k):
+        """
+        Memory-mapped chunk k of a dataset, opened for writing (created if needed).
+        """
+        ds = self.dict['datasets'][name]
+        if name in self.chunks and self.chunks[name][0] == k:
+            return self.chunks[name][1]
+        if name in self.chunks:
+            self.chunks[name][1].flush()
+
+        path = self.chunk_path(name, k)
+        if os.path.exists(path):
+            mm = np.lib.format.open_memmap(path, mode='r+')
+        else:
+            mm = np.lib.format.open_memmap(path, mode='w+', dtype=np.dtype(ds['dtype']),
+                                           shape=(ds['chunkRows'],) + tuple(ds['shape']))
+        self.chunks[name] = (k, mm)
+        return mm
+
+    def append(self, name, rows):
+        """
+        Append rows to a dataset. rows has shape (n,) + shape of a row, or the shape of one row.
+        """
+        self.check_writable()
+        ds = self.dict['datasets'][name]
+        rows = np.asarray(rows)
+        if rows.shape == tuple(ds['shape']):
+            rows = rows[np.newaxis]
+        if rows.shape[1:] != tuple(ds['shape']):
+            raise ValueError("Rows of %s have shape %s, not %s" % (name, tuple(ds['shape']), rows.shape[1:]))
+
+        n0 = ds['nrows']
+        i = 0
+        while i < len(rows):
+            k, offset = divmod(n0 + i, ds['chunkRows'])
+            n = min(len(rows) - i, ds['chunkRows'] - offset)
+            mm = self.chunk(name, k)
+            mm[offset:offset+n] = rows[i:i+n]
+            i += n
+
+        # Data first, then the row count.
+        self.chunks[name][1].flush()
+        ds['nrows'] = n0 + len(rows)
+        self.write_nrows(name)
+
+    def read(self, name, start=0, stop=None, tones=None):
+        """
+        Read rows [start, stop) of a dataset, only loading the chunks needed.
+
+        Parameters:
+        -----------
+            tones : int, list or slice (default None)
+                index on the second axis (tone number) to return, None for all
+
+        Returns:
+        --------
+            rows : ndarray
+        """
+        ds = self.dict['datasets'][name]
+        nrows = ds['nrows']
+        if stop is None or stop > nrows:
+            stop = nrows
+        if tones is None:
+            tones = slice(None)
+
+        parts = []
+        i = start
+        while i < stop:
+            k, offset = divmod(i, ds['chunkRows'])
+            n = min(stop - i, ds['chunkRows'] - offset)
+            mm = np.load(self.chunk_path(name, k), mmap_mode='r')
+            parts.append(np.array(mm[offset:offset+n, tones]))
+            i += n
+        if len(parts) == 0:
+            empty = np.zeros((0,) + tuple(ds['shape']), dtype=np.dtype(ds['dtype']))
+            return empty[:, tones]
+        return np.concatenate(parts)
+
+    def close(self):
+        for k, mm in self.chunks.values():
+            mm.flush()
+        self.chunks = {}
+        if self.mode == 'a':
+            self.write_meta()
@@ -0,0 +1,58 @@
+"""
+Fit quality of fitResonances on a simulated multi-tone sweep.
+
+Run with: python -m pytest test_resonanceFitter.py
+"""
+import warnings
+import numpy as np
+from resonanceFitter import *
+
+def mixedSweep(nTones=200, nf=30, noise=25, seed=0):
+    """
+    Resonators with different quality factors, depths, rotations and positions in the sweep window.
+
+    Returns the frequencies, the measured values, the true parameters and the cost of the true model.
+    """
+    rng = np.random.default_rng(seed)
+    p = np.array([789892.56, 5.6930312E6, 3.6921007, 1738.3526, 4849.9218, 0.43856595, 1202.1240, 1280.4136, 7164.7115, 11181.436])
+    ps = np.tile(p, (nTones, 1))
+    ps[:,0] *= rng.uniform(0.3, 2, nTones)
+    ps[:,1] += rng.uniform(-1e4, 1e4, nTones)
+    ps[:,5] = rng.uniform(0, 2*np.pi, nTones)
+    ps[:,6] *= rng.uniform(0.5, 2, nTones)
+    ps[:,7] = ps[:,6]*rng.uniform(0.8, 1.2, nTones)
+    freqs = ps[:,1] + np.linspace(-22, 18, nf)[:,None] + rng.uniform(-3, 3, nTones)
+    iqs = mazinResonanceComplex(freqs, *ps.T)
+    iqs += noise*(rng.standard_normal(iqs.shape) + 1j*rng.standard_normal(iqs.shape))
+    costTrue = (np.abs(mazinResonanceComplex(freqs, *ps.T) - iqs)**2).sum(axis=0)
+    return freqs, iqs, ps, costTrue
+
+def test_fitResonances_quality():
+    freqs, iqs, ps, costTrue = mixedSweep()
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        popt, pcov, success, info = fitResonances(freqs, iqs, full_output=True)
+
+    # Failed fits are reported, and have no parameters.
+    assert success.mean() > 0.95
+    assert np.isnan(popt[~success]).all()
+    assert np.isfinite(popt[success]).all()
+
+    # Successful fits are as good as the true model, within the noise.
+    ratio = info['cost'][success]/costTrue[success]
+    assert np.mean(ratio <= 1.1) > 0.9
+    assert ratio.max() < 2
+
+    # Resonance frequencies within a fraction of the line width.
+    width = ps[success,1]/np.abs(ps[success,0])
+    assert np.median(np.abs(popt[success,1] - ps[success,1])/width) < 0.05
+
+def test_fitResonances_without_refit():
+    # The stacked fit alone converges within maxIter.
+    freqs, iqs, ps, costTrue = mixedSweep(nTones=50)
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        popt, pcov, success, info = fitResonances(freqs, iqs, refitCost=None, maxCost=None, full_output=True)
+    assert not info['refit'].any()
+    assert success.all()
+    assert info['nit'].max() < 1100